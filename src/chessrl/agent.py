@@ -1,11 +1,10 @@
-import numpy as np
-
 import mctree
 import netencoder
 
 from player import Player
 from model import ChessModel
 from dataset import DatasetGame
+from evalcache import EvaluationCache
 
 
 class Agent(Player):
@@ -13,16 +12,26 @@ class Agent(Player):
 
     Parameters:
         model: Model. Model encapsulating the neural network operations.
-        move_encodings: list. List of all possible uci movements.
-        uci_dict: dict. Dictionary with mappings 'uci'-> int. It's used
-        to predict the policy only over the legal movements.
+        move_encodings: list. List of all possible uci movements
+        (netencoder.UCI_LABELS).
+        uci_dict: dict. Dictionary with mappings 'uci'-> int
+        (netencoder.UCI_IDS).
+        batch_size: int. Number of leaves the MCTS evaluates at once (in a
+        single prediction).
+        cache: EvaluationCache. Latest predictions of the model (None if
+        cache_size is 0). It's cleared when the weights change.
     """
-    def __init__(self, color, weights=None):
+    def __init__(self, color, weights=None, batch_size=8, cache_size=0):
         super().__init__(color)
 
         self.model = ChessModel(compile_model=True, weights=weights)
-        self.move_encodings = netencoder.get_uci_labels()
-        self.uci_dict = {u: i for i, u in enumerate(self.move_encodings)}
+        self.batch_size = batch_size
+        # Shared by all the agents (see netencoder.MOVE_INDEX)
+        self.move_encodings = netencoder.UCI_LABELS
+        self.uci_dict = netencoder.UCI_IDS
+        self.cache = None
+        if cache_size > 0:
+            self.cache = EvaluationCache(cache_size)
 
     def best_move(self, game:'Game', real_game=False, max_iters=900, verbose=False) -> str:  # noqa: E0602, F821
         """ Finds and returns the best possible move (UCI encoded)
@@ -39,40 +48,84 @@ class Agent(Player):
         """
         best_move = '00000'  # Null move
         if real_game:
-            policy = self.predict_policy(game)
-            best_move = game.get_legal_moves()[np.argmax(policy)]
+            policy = self.predict(game)[0]
+            best_move = netencoder.get_policy_move(policy, game).uci()
         else:
             if game.get_result() is None:
-                current_tree = mctree.Tree(game)
+                current_tree = mctree.Tree(game, coroutines=self.batch_size)
                 best_move = current_tree.search_move(self, max_iters=max_iters, verbose=verbose)
         return best_move
 
     def predict_outcome(self, game:'Game') -> float:  # noqa: E0602, F821
         """ Predicts the outcome of a game from the current position """
-        game_matr = netencoder.get_game_state(game)
-        return self.model.predict(np.expand_dims(game_matr, axis=0))[1][0][0]
+        return self.predict(game)[1]
 
     def predict_policy(self, game:'Game', mask_legal_moves=True) -> float:  # noqa: E0602, F821
         """ Predict the policy distribution over all possible moves. """
-        game_matr = netencoder.get_game_state(game)
-        policy = self.model.predict(np.expand_dims(game_matr, axis=0))[0][0]
+        policy = self.predict(game)[0]
         if mask_legal_moves:
-            legal_moves = game.get_legal_moves()
-            policy = [policy[self.uci_dict[x]] for x in legal_moves]
+            policy = netencoder.get_legal_priors(policy, game)
         return policy
 
+    def predict(self, game:'Game'):  # noqa: E0602, F821
+        """ Predicts from a game board and returns policy / value"""
+        return self.predict_batch([game])[0]
+
+    def predict_batch(self, games):
+        """ Predicts several games with a single call to the model. The
+        games in the cache aren't predicted again.
+
+        Parameters:
+            games: list[Game]. Games to predict.
+        Returns:
+            list[(policy, value)]. Prediction for each game.
+        """
+        packed = netencoder.pack_games(games)
+        predictions = [None] * len(games)
+        if self.cache is not None:
+            keys = [p.tobytes() for p in packed]
+            predictions = [self.cache.lookup(k) for k in keys]
+
+        pending = [i for i, p in enumerate(predictions) if p is None]
+        if len(pending) > 0:
+            game_matr = netencoder.unpack_states(packed[pending])
+            policies, values = self.model.predict(game_matr)
+            for j, i in enumerate(pending):
+                predictions[i] = (policies[j], values[j][0])
+                if self.cache is not None:
+                    self.cache.store(keys[i], policies[j], values[j][0])
+        return predictions
+
+    def evaluate_batch(self, games):
+        """ Evaluates several games with a single call to the model.
+
+        Parameters:
+            games: list[Game]. Games to evaluate.
+        Returns:
+            list[(priors, value)]. Priors of the legal moves and value of
+            each game.
+        """
+        return [(netencoder.get_legal_priors(policy, g), value)
+                for g, (policy, value) in zip(games,
+                                              self.predict_batch(games))]
+
     def train(self, dataset: DatasetGame,
               epochs=1, logdir=None, batch_size=1,
               validation_split=0):
-        """ Trains the model using previous recorded games """
+        """ Trains the model using previous recorded games (a DatasetGame or
+        a netencoder.PositionShard).
+        """
         if len(dataset) <= 0:
             return
 
         if validation_split > 0:
             split_point = len(dataset) - int(validation_split * len(dataset))
 
-            games_train = DatasetGame(dataset[:split_point])
-            games_val = DatasetGame(dataset[split_point:])
+            games_train = dataset[:split_point]
+            games_val = dataset[split_point:]
+            if isinstance(dataset, DatasetGame):
+                games_train = DatasetGame(games_train)
+                games_val = DatasetGame(games_val)
             val_gen = netencoder.DataGameSequence(games_val,
                                                   batch_size=batch_size)
         else:
@@ -87,12 +140,16 @@ class Agent(Player):
                                    epochs=epochs,
                                    logdir=logdir,
                                    val_gen=val_gen)
+        if self.cache is not None:
+            self.cache.clear()
 
     def save(self, path):
         self.model.save_weights(path)
 
     def load(self, path):
         self.model.load_weights(path)
+        if self.cache is not None:
+            self.cache.clear()
 
     def clone(self):
         return Agent(self.color, '../../data/models/model1-unsuperv/model-0.h5')
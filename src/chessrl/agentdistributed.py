@@ -1,11 +1,56 @@
-import numpy as np
-
 import mctree
 import netencoder
 
 from player import Player
+from evalcache import EvaluationCache
+from rootparallel import RootParallelTree
+from transposition import TranspositionTable
 
 from multiprocessing.connection import Client
+from queue import LifoQueue, Empty
+from threading import Lock
+
+
+class ConnectionPool(object):
+    """ Thread-safe pool of connections to a PredictWorker. The connections
+    are opened when there isn't an idle one and kept open until close(), so
+    the search threads don't pay the connection setup on every iteration.
+
+    Attributes:
+        address: (str, int). Address of the PredictWorker.
+        connections: list[Connection]. All the open connections.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.connections = []
+        self.idle = LifoQueue()
+        self.lock = Lock()
+
+    def acquire(self):
+        """ Returns an idle connection (opening a new one if there isn't any).
+        """
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            conn = Client(self.address)
+            with self.lock:
+                self.connections.append(conn)
+            return conn
+
+    def release(self, conn):
+        """ Gives back a connection taken with acquire(). """
+        self.idle.put(conn)
+
+    def close(self):
+        """ Closes all the connections. """
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.idle = LifoQueue()
+
+    def __len__(self):
+        return len(self.connections)
 
 
 class AgentDistributed(Player):
@@ -16,28 +61,84 @@ class AgentDistributed(Player):
     version of the Monte Carlo Tree Search.
 
     Attributes:
-        move_encodings: list. List of all possible uci movements.
-        uci_dict: dict. Dictionary with mappings 'uci'-> int. It's used
-        to predict the policy only over the legal movements.
+        move_encodings: list. List of all possible uci movements
+        (netencoder.UCI_LABELS).
+        uci_dict: dict. Dictionary with mappings 'uci'-> int
+        (netencoder.UCI_IDS).
         endpoint: (str, int). Tuple with the address, port of the PredictWorker
         num_threads: int. Number of threads to use during MTCS
+        compact_tree: bool. Whether to use a CompactSelfPlayTree (nodes stored
+        in arrays) instead of a SelfPlayTree during MCTS.
+        ply_tree: bool. Whether to use a PlySelfPlayTree (a node per ply,
+        the opponent moves are searched too). Can't be used with
+        compact_tree.
+        batch_size: int. Number of leaves each MCTS thread sends at once to
+        the worker to be evaluated.
+        reuse_tree: bool. Whether to keep the search tree between moves. The
+        next search starts from the subtree of the moves that were played.
+        tree: Tree. Tree of the last search.
+        search_info: dict. Budget spent by the last search (see
+        SelfPlayTree.search_info).
+        transpositions: TranspositionTable. Table shared by all the searches
+        of the agent (None if transposition_size is 0).
+        processes: int. Number of processes of the root parallel search (0
+        to search with the threads of a single tree). Each process uses
+        num_threads threads and its own transposition table.
+        cache: EvaluationCache. Latest predictions received from the worker,
+        shared with the copies of the agent (None if cache_size is 0).
+        max_nodes: int. Node cap of the SelfPlayTree searches (None for no
+        limit). CompactSelfPlayTree doesn't support it.
+        widening: float. Progressive widening of the SelfPlayTree searches
+        (see SelfPlayTree, None disables it). CompactSelfPlayTree doesn't
+        support it.
         conn: Connection. Connection to the prediction worker that is in use
-        pool_conns: list[Connection]. Pool of connections that will be used
-        during MCTS.
+        pool_conns: ConnectionPool. Pool of connections that will be used
+        during MCTS. It's created on connect() and shared with the copies of
+        the agent (get_copy()), which take their connection from it.
+        pooled: bool. Whether conn is taken from the pool of another agent.
+        executor: SearchExecutor. Threads of the MCTS searches. They're
+        started with the first search and live until disconnect().
     """
-    def __init__(self, color, endpoint=None, num_threads=6):
+    def __init__(self, color, endpoint=None, num_threads=6,
+                 compact_tree=False, batch_size=1, reuse_tree=True,
+                 transposition_size=0, processes=0, cache_size=0,
+                 max_nodes=None, ply_tree=False, widening=None):
         super().__init__(color)
 
-        self.move_encodings = netencoder.get_uci_labels()
-        self.uci_dict = {u: i for i, u in enumerate(self.move_encodings)}
+        if compact_tree and ply_tree:
+            raise ValueError("The compact tree doesn't support ply_tree")
+
+        # Shared by all the agents (see netencoder.MOVE_INDEX)
+        self.move_encodings = netencoder.UCI_LABELS
+        self.uci_dict = netencoder.UCI_IDS
 
         self.conn = None
         self.pool_conns = None
+        self.pooled = False
+        self.executor = None
         self.address = endpoint
         self.num_threads = num_threads
+        self.compact_tree = compact_tree
+        self.ply_tree = ply_tree
+        self.batch_size = batch_size
+        self.reuse_tree = reuse_tree
+        self.tree = None
+        self.search_info = None
+        self.processes = processes
+        self.max_nodes = max_nodes
+        self.widening = widening
+        self.cache_size = cache_size
+        self.cache = None
+        if cache_size > 0 and processes == 0:
+            self.cache = EvaluationCache(cache_size)
+        self.transposition_size = transposition_size
+        self.transpositions = None
+        if transposition_size > 0 and processes == 0:
+            self.transpositions = TranspositionTable(transposition_size)
 
     def best_move(self, game:'Game', real_game=False, max_iters=900,  # noqa: E0602, F821
-                  ai_move=True, verbose=False) -> str:
+                  ai_move=True, verbose=False, max_time=None,
+                  early_stop=False, stats=False) -> str:
         """ Finds and returns the best possible move (UCI encoded)
 
         Parameters:
@@ -48,64 +149,171 @@ class AgentDistributed(Player):
             of the MCTS algorithm.
             verbose: Whether to print debug info
             ai_move: bool. Whether to return the next move of the AI
+            max_time: float. Max. seconds of the MCTS search (None for no
+            limit).
+            early_stop: bool. Whether to stop the search once the best move
+            can't change in the remaining budget.
+            stats: bool. Whether to collect the SearchStats of the search
+            (in search_info['stats']).
 
         Returns:
             str. UCI encoded movement.
         """
         best_move = '00000'  # Null move
         if real_game:
-            policy = self.predict_policy(game)
-            best_move = game.get_legal_moves()[np.argmax(policy)]
+            policy = self.predict(game)[0]
+            best_move = netencoder.get_policy_move(policy, game).uci()
         else:
             if game.get_result() is None:
-                current_tree = mctree.SelfPlayTree(
-                    game,
-                    threads=self.num_threads)
+                current_tree = self.tree
+                if self.processes > 0:
+                    # The processes (and their trees) live between moves
+                    if current_tree is None:
+                        current_tree = RootParallelTree(
+                            game, self.address,
+                            processes=self.processes,
+                            threads=self.num_threads,
+                            compact=self.compact_tree,
+                            ply=self.ply_tree,
+                            batch_size=self.batch_size,
+                            transposition_size=self.transposition_size,
+                            cache_size=self.cache_size,
+                            max_nodes=self.max_nodes,
+                            widening=self.widening,
+                            reuse_tree=self.reuse_tree)
+                        self.tree = current_tree
+                    else:
+                        current_tree.reroot(game)
+                elif not self.reuse_tree or current_tree is None or \
+                        not current_tree.reroot(game):
+                    if self.executor is None:
+                        self.executor = mctree.SearchExecutor(
+                            self.num_threads)
+                    tree_args = {'max_nodes': self.max_nodes,
+                                 'widening': self.widening}
+                    tree_class = mctree.SelfPlayTree
+                    if self.compact_tree:
+                        tree_class = mctree.CompactSelfPlayTree
+                        tree_args = {}
+                    elif self.ply_tree:
+                        tree_class = mctree.PlySelfPlayTree
+                    current_tree = tree_class(
+                        game,
+                        threads=self.num_threads,
+                        batch_size=self.batch_size,
+                        transpositions=self.transpositions,
+                        executor=self.executor,
+                        **tree_args)
+                if self.reuse_tree and self.processes == 0:
+                    self.tree = current_tree
                 best_move = current_tree.search_move(self, max_iters=max_iters,
                                                      verbose=verbose,
-                                                     ai_move=ai_move)
+                                                     ai_move=ai_move,
+                                                     max_time=max_time,
+                                                     early_stop=early_stop,
+                                                     stats=stats)
+                self.search_info = current_tree.search_info
 
         return best_move
 
     def predict_outcome(self, game:'Game') -> float:  # noqa: E0602, F821
         """ Predicts the outcome of a game from the current position """
-        response = self.__send_game(game)
+        response = self.predict(game)
         return response[1]
 
     def predict_policy(self, game:'Game', mask_legal_moves=True) -> float:  # noqa: E0602, F821
         """ Predict the policy distribution over all possible moves. """
-        response = self.__send_game(game)
+        response = self.predict(game)
         policy = response[0]
 
         if mask_legal_moves:
-            legal_moves = game.get_legal_moves()
-            policy = [policy[self.uci_dict[x]] for x in legal_moves]
+            policy = netencoder.get_legal_priors(policy, game)
         return policy
 
     def predict(self, game:'Game'):  # noqa: E0602, F821
         """ Predicts from a game board and returns policy / value"""
-        response = self.__send_game(game)
-        return response
+        return self.predict_batch([game])[0]
+
+    def predict_batch(self, games):
+        """ Predicts several games with a single request to the worker (their
+        packed inputs, see netencoder.pack_games). The games in the cache
+        aren't sent.
+
+        Parameters:
+            games: list[Game]. Games to predict.
+        Returns:
+            list[(policy, value)]. Prediction for each game.
+        """
+        packed = netencoder.pack_games(games)
+        if self.cache is None:
+            self.conn.send(packed)
+            return self.conn.recv()
+
+        keys = [p.tobytes() for p in packed]
+        predictions = [self.cache.lookup(k) for k in keys]
+        pending = [i for i, p in enumerate(predictions) if p is None]
+        if len(pending) > 0:
+            self.conn.send(packed[pending])
+            for i, response in zip(pending, self.conn.recv()):
+                predictions[i] = response
+                self.cache.store(keys[i], *response)
+        return predictions
+
+    def evaluate(self, game:'Game'):  # noqa: E0602, F821
+        """ Evaluates a game with a single request to the worker.
+
+        Returns:
+            (priors, value). Priors of the legal moves and value of the game.
+        """
+        policy, value = self.predict(game)
+        return netencoder.get_legal_priors(policy, game), value
 
-    def __send_game(self, game:'Game'):  # noqa: E0602, F821
-        """ Sends a game to the neural net. and blocks the caller thread until
-        the prediction is done.
+    def evaluate_batch(self, games):
+        """ Evaluates several games with a single request to the worker.
 
         Parameters:
-            game: Game. Game to send. to worker.
+            games: list[Game]. Games to evaluate.
+        Returns:
+            list[(priors, value)]. Priors of the legal moves and value of
+            each game.
         """
-        self.conn.send(game)
-        response = self.conn.recv()
-        return response
+        return [(netencoder.get_legal_priors(policy, g), value)
+                for g, (policy, value) in zip(games,
+                                              self.predict_batch(games))]
 
     def get_copy(self):
-        """ Returns an empty agent with the color of this one """
+        """ Returns an empty agent with the color of this one. If this agent
+        is connected, the copy uses its pool of connections.
+        """
         copy = AgentDistributed(self.color, endpoint=self.address)
+        copy.cache = self.cache
+        if self.pool_conns is not None:
+            copy.pool_conns = self.pool_conns
+            copy.pooled = True
         return copy
 
     def connect(self):
-        self.conn = Client(self.address)
+        if self.pooled:
+            self.conn = self.pool_conns.acquire()
+        else:
+            self.conn = Client(self.address)
+            self.pool_conns = ConnectionPool(self.address)
 
     def disconnect(self):
-        self.conn.close()
+        if self.executor is not None:
+            # Its threads give their connections back to the pool
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.pooled:
+            self.pool_conns.release(self.conn)
+        else:
+            self.conn.close()
+            self.pool_conns.close()
+            self.pool_conns = None
         self.conn = None
+
+        if self.processes > 0 and self.tree is not None:
+            # Stop the root parallel search processes
+            self.tree.close()
+            self.tree = None
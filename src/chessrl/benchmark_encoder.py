@@ -0,0 +1,370 @@
+""" This script measures the throughput (positions/sec) of the encoders of
+netencoder on positions of random games, and checks that all of them give
+the same input as get_game_state(). It also measures the encoding of every
+position of the games as their moves are made, with and without keeping
+their EncodedHistory, the encoding of batches of positions (one array
+per position or get_game_states() on a reused array) and the size and speed
+of the packed positions.
+
+With --check, it only checks the encoders, the packed positions (their
+round trip and the PositionShard files) and the policy move index, and
+exits with an error if any of them is wrong.
+"""
+
+from game import Game
+from lib.logger import Logger
+from timeit import default_timer as timer
+
+import argparse
+import os
+import pickle
+import sys
+import tempfile
+import numpy as np
+
+import netencoder
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
+
+
+ENCODERS = {
+    'lists': netencoder.get_game_state,
+    'bitboards': netencoder.get_game_state_bitboards,
+    'batch': lambda game, flipped=False: netencoder.get_game_states(
+        [game], dtype=np.float64, flipped=flipped)[0],
+}
+
+
+def random_games(n, max_moves=120, seed=0):
+    """ Returns n games, each one stopped after a random number of random
+    moves (so there are positions with and without a full history).
+
+    Parameters:
+        n: int. Number of games.
+        max_moves: int. Max. number of moves of each game.
+        seed: int. Seed of the random moves.
+    Returns:
+        games: list[Game].
+    """
+    rng = np.random.RandomState(seed)
+    games = []
+    for _ in range(n):
+        game = Game()
+        for _ in range(rng.randint(0, max_moves + 1)):
+            moves = game.get_legal_moves()
+            if len(moves) == 0:
+                break
+            game.move(moves[rng.randint(len(moves))])
+        games.append(game)
+    return games
+
+
+def check_encoders(games, encoders=ENCODERS):
+    """ Checks that the encoders give exactly the same result as
+    get_game_state() (flipped and not flipped).
+
+    Parameters:
+        games: list[Game]. Games to encode.
+        encoders: dict. name -> encoder (same arguments as get_game_state).
+    Returns:
+        mismatches: dict. name -> number of games encoded differently.
+    """
+    mismatches = {name: 0 for name in encoders}
+    for game in games:
+        for flipped in (False, True):
+            expected = netencoder.get_game_state(game, flipped=flipped)
+            for name, encoder in encoders.items():
+                state = encoder(game, flipped=flipped)
+                if state.dtype != expected.dtype or \
+                        not np.array_equal(state, expected):
+                    mismatches[name] += 1
+    return mismatches
+
+
+def bench_encoders(games, encoders=ENCODERS, repetitions=3):
+    """ Measures the positions encoded per second by each encoder.
+
+    Parameters:
+        games: list[Game]. Games to encode.
+        encoders: dict. name -> encoder.
+        repetitions: int. Times each game is encoded.
+    Returns:
+        results: dict. name -> positions/sec.
+    """
+    logger = Logger.get_instance()
+    results = {}
+    for name, encoder in encoders.items():
+        start = timer()
+        for _ in range(repetitions):
+            for game in games:
+                encoder(game)
+        results[name] = repetitions * len(games) / (timer() - start)
+        logger.info(f"{name}: {round(results[name])} positions/sec")
+    return results
+
+
+def _replay(game, track):
+    """ Yields the positions of a game, as a new game (which keeps its
+    EncodedHistory if track is True) where its moves are made.
+    """
+    replay = Game()
+    if track:
+        netencoder.track_history(replay)
+    for move in game.board.move_stack:
+        replay.push(move)
+        yield replay
+
+
+def check_history(games):
+    """ Checks that the EncodedHistory of the games gives exactly the same
+    input as encoding every position again.
+
+    Parameters:
+        games: list[Game]. Games to replay.
+    Returns:
+        mismatches: int. Number of positions encoded differently.
+    """
+    mismatches = 0
+    for game in games:
+        for replay in _replay(game, track=True):
+            expected = netencoder.get_game_state(Game(board=replay.board))
+            mismatches += not np.array_equal(
+                netencoder.get_game_state(replay), expected)
+    return mismatches
+
+
+def bench_history(games):
+    """ Replays the games encoding every position (as the searches and the
+    training do with the positions of a game). Without the EncodedHistory,
+    each position encodes the last 8 again.
+
+    Parameters:
+        games: list[Game]. Games to replay.
+    Returns:
+        results: dict. 'full'/'incremental' -> positions/sec.
+    """
+    logger = Logger.get_instance()
+    results = {}
+    for name, track in (('full', False), ('incremental', True)):
+        positions = 0
+        start = timer()
+        for game in games:
+            for replay in _replay(game, track):
+                netencoder.get_game_state(replay)
+                positions += 1
+        results[name] = positions / (timer() - start)
+        logger.info(f"History {name}: {round(results[name])} positions/sec")
+    return results
+
+
+def check_packing(games):
+    """ Checks that the packed positions (pack_games) give back exactly the
+    input of get_game_state() (flipped and not flipped, also when they're
+    written into a float16 array or saved in a PositionShard), and that a
+    game packs to the same bytes (cache key) with and without its
+    EncodedHistory.
+
+    Parameters:
+        games: list[Game]. Games to pack.
+    Returns:
+        mismatches: dict. 'unpack'/'float16'/'shard'/'key' -> number of
+        games which differ.
+    """
+    mismatches = {'unpack': 0, 'float16': 0, 'shard': 0, 'key': 0}
+    packed = netencoder.pack_games(games)
+    for flipped in (False, True):
+        unpacked = netencoder.unpack_states(packed, dtype=np.float64,
+                                            flipped=flipped)
+        for state, game in zip(unpacked, games):
+            expected = netencoder.get_game_state(game, flipped=flipped)
+            mismatches['unpack'] += not np.array_equal(state, expected)
+
+    out = np.empty((len(games) + 1, 8, 8, 127), dtype=np.float16)
+    netencoder.unpack_states(packed, out=out)
+    expected = netencoder.get_game_states(games, dtype=np.float16)
+    mismatches['float16'] = int(sum(not np.array_equal(a, b)
+                                    for a, b in zip(out, expected)))
+
+    # Each game as a game of a single position
+    n = len(games)
+    shard = netencoder.PositionShard(packed, np.zeros(n, dtype=np.int16),
+                                     np.zeros(n, dtype=np.float32),
+                                     np.arange(n + 1))
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'shard.npz')
+        shard.save(path)
+        loaded = netencoder.PositionShard.load(path)
+    mismatches['shard'] = sum(a.tobytes() != b.tobytes()
+                              for a, b in zip(loaded.positions, packed))
+
+    for game, record in zip(games, packed):
+        tracked = netencoder.track_history(Game(board=game.board.copy()))
+        untracked = Game(board=game.board.copy())
+        untracked.encoded_history = None
+        keys = {netencoder.pack_games([g])[0].tobytes()
+                for g in (tracked, untracked)}
+        mismatches['key'] += keys != {record.tobytes()}
+    return mismatches
+
+
+def check_move_index(games):
+    """ Checks the policy move tables: MOVE_INDEX gives the index of
+    UCI_IDS of every move of the policy (and nothing else), and the indices
+    and priors of the legal moves of the games are the ones found by their
+    UCI.
+
+    Parameters:
+        games: list[Game]. Games whose legal moves are checked.
+    Returns:
+        mismatches: dict. 'labels' (moves of the policy with a wrong index
+        or extra indices in MOVE_INDEX), 'legal' and 'best' (games with a
+        wrong index or best move) -> count.
+    """
+    mismatches = {'labels': 0, 'legal': 0, 'best': 0}
+    for label, index in netencoder.UCI_IDS.items():
+        move = netencoder.POLICY_MOVES[index]
+        found = netencoder.MOVE_INDEX[move.from_square, move.to_square,
+                                      move.promotion or 0]
+        mismatches['labels'] += bool(move.uci() != label or found != index)
+    mismatches['labels'] += abs(int(np.sum(netencoder.MOVE_INDEX >= 0)) -
+                                len(netencoder.UCI_IDS))
+
+    rng = np.random.RandomState(0)
+    for game in games:
+        moves = game.get_legal_moves()
+        if len(moves) == 0:
+            continue
+        indices = netencoder.get_move_indices(game.board.legal_moves)
+        expected = [netencoder.UCI_IDS[m] for m in moves]
+        mismatches['legal'] += list(indices) != expected
+
+        policy = rng.rand(len(netencoder.UCI_LABELS))
+        best = moves[int(np.argmax(policy[expected]))]
+        mismatches['best'] += \
+            netencoder.get_policy_move(policy, game).uci() != best
+    return mismatches
+
+
+def bench_batches(games, batch_size=32, repetitions=3):
+    """ Measures the positions/sec of encoding the games in batches of float16
+    inputs (as the PredictWorker does): stacking the arrays of
+    get_game_state() or writing all of them with get_game_states() into the
+    same array.
+
+    Parameters:
+        games: list[Game]. Games to encode.
+        batch_size: int. Games of each batch.
+        repetitions: int. Times each game is encoded.
+    Returns:
+        results: dict. 'stacked'/'in place' -> positions/sec.
+    """
+    logger = Logger.get_instance()
+    batches = [games[i:i + batch_size]
+               for i in range(0, len(games), batch_size)]
+    out = np.empty((batch_size, 8, 8, 127), dtype=np.float16)
+    methods = {
+        'stacked': lambda b: np.asarray([netencoder.get_game_state(g)
+                                         for g in b], dtype=np.float16),
+        'in place': lambda b: netencoder.get_game_states(b, out=out),
+    }
+    results = {}
+    for name, encode in methods.items():
+        start = timer()
+        for _ in range(repetitions):
+            for batch in batches:
+                encode(batch)
+        results[name] = repetitions * len(games) / (timer() - start)
+        logger.info(f"Batches {name}: {round(results[name])} positions/sec")
+    return results
+
+
+def bench_packing(games, repetitions=3):
+    """ Compares the bytes per position of the games sent to the
+    PredictWorker (pickled games, packed inputs and float16 inputs) and
+    measures the positions/sec of pack_games() and unpack_states().
+
+    Parameters:
+        games: list[Game]. Games to pack.
+        repetitions: int. Times each game is packed and unpacked.
+    Returns:
+        results: dict. 'bytes' (dict with the bytes per position of each
+        form) and 'pack' and 'unpack' (positions/sec).
+    """
+    logger = Logger.get_instance()
+    packed = netencoder.pack_games(games)
+    states = netencoder.get_game_states(games, dtype=np.float16)
+    results = {'bytes': {'game': len(pickle.dumps(games)) / len(games),
+                         'packed': len(pickle.dumps(packed)) / len(games),
+                         'float16': states.nbytes / len(games)}}
+    for name, size in results['bytes'].items():
+        logger.info(f"Size {name}: {round(size)} bytes/position")
+
+    out = np.empty_like(states)
+    for name, run in (('pack', lambda: netencoder.pack_games(games)),
+                      ('unpack', lambda: netencoder.unpack_states(
+                          packed, out=out))):
+        start = timer()
+        for _ in range(repetitions):
+            run()
+        results[name] = repetitions * len(games) / (timer() - start)
+        logger.info(f"{name}: {round(results[name])} positions/sec")
+    return results
+
+
+def run_checks(games):
+    """ Runs all the checks on the games, logging the wrong ones.
+
+    Parameters:
+        games: list[Game]. Games to check.
+    Returns:
+        failures: int. Number of mismatches found.
+    """
+    logger = Logger.get_instance()
+    checks = [('Encoder', check_encoders(games)),
+              ('EncodedHistory', {'replay': check_history(games)}),
+              ('Packed', check_packing(games)),
+              ('Move index', check_move_index(games))]
+    failures = 0
+    for check, mismatches in checks:
+        for name, count in mismatches.items():
+            if count > 0:
+                logger.error(f"{check} {name}: {count} mismatches")
+            failures += count
+    if failures == 0:
+        logger.info(f"All the checks passed on {len(games)} games")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the throughput "
+                                     "of the board encoders.")
+    parser.add_argument('--games', metavar='games', type=int, default=200,
+                        help="Number of random positions")
+    parser.add_argument('--max-moves', metavar='max_moves', type=int,
+                        default=120, help="Max. moves of each random game")
+    parser.add_argument('--repetitions', metavar='repetitions', type=int,
+                        default=3, help="Times each position is encoded")
+    parser.add_argument('--batch-size', metavar='batch_size', type=int,
+                        default=32, help="Positions of each batch")
+    parser.add_argument('--check', action='store_true', default=False,
+                        help="Only run the checks (exits with an error if "
+                        "any of them fails)")
+    args = parser.parse_args()
+
+    logger = Logger.get_instance()
+    logger.set_level(1)
+
+    games = random_games(args.games, max_moves=args.max_moves)
+    failures = run_checks(games)
+    if args.check:
+        sys.exit(1 if failures > 0 else 0)
+
+    bench_encoders(games, repetitions=args.repetitions)
+    bench_history(games)
+    bench_batches(games, batch_size=args.batch_size,
+                  repetitions=args.repetitions)
+    bench_packing(games, repetitions=args.repetitions)
+
+
+if __name__ == "__main__":
+    main()
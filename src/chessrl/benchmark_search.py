@@ -0,0 +1,366 @@
+""" This script measures the throughput of the tree search. There are several
+benchmarks (see the subcommands):
+    batch: Evaluated nodes per second for several batch sizes. A
+        PredictWorker is started on this process and the searches are run on a
+        separate one (as in selfplay.py).
+    selection: Child selections per second on a wide node (no neural net).
+    parallel: Nodes per second of the threaded search with 1..N threads and
+        of the root parallel search with 1..N processes.
+    scheduling: Time per move of short searches, starting the search threads
+        on each search or using a persistent SearchExecutor.
+"""
+
+from agentdistributed import AgentDistributed
+from game import Game
+from mctree import SelfPlayTree, CompactSelfPlayTree, Node, PUCT_C
+from mctree import SearchExecutor
+from predict_worker import PredictWorker
+from rootparallel import RootParallelTree
+from searchstats import SearchStats
+from lib.logger import Logger
+from timeit import default_timer as timer
+
+import argparse
+import multiprocessing
+import os
+import chess
+import numpy as np
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
+
+# Middlegame position with 46 legal moves
+WIDE_FEN = 'r2q1rk1/pp2bppp/2n1bn2/3p4/3P4/2NBBN2/PP3PPP/R2Q1RK1 w - - 0 11'
+
+
+def search_job(endpoint, result_placeholder, searches, max_iters,
+               tree_args, max_time=None, early_stop=False, stats=False):
+    """ Runs several searches from the initial position and stores the
+    number of nodes evaluated per second.
+
+    Parameters:
+        endpoint: (str, int). Address of the PredictWorker.
+        result_placeholder: dict. Where the results are stored ('nps',
+            'iters', the mean iterations spent by each search, and 'stats',
+            the SearchStats of all the searches if stats is True).
+        searches: int. Number of searches to run.
+        max_iters: int. Iterations of each search.
+        tree_args: dict. Arguments of the tree (threads, batch_size...).
+            compact=True will use a CompactSelfPlayTree, processes=N a
+            RootParallelTree with N processes and persistent=True a
+            SearchExecutor shared by all the searches.
+        max_time: float. Max. seconds of each search.
+        early_stop: bool. Whether to stop the searches once their best move
+            can't change.
+        stats: bool. Whether to collect the SearchStats of the searches.
+    """
+    agent = AgentDistributed(Game.WHITE, endpoint=endpoint)
+    agent.connect()
+    game = Game()
+
+    tree_args = dict(tree_args)
+    processes = tree_args.pop('processes', 0)
+    tree = None
+    if processes > 0:
+        # The processes are started before the timing (they live between
+        # searches)
+        tree = RootParallelTree(game, endpoint, processes=processes,
+                                reuse_tree=False, **tree_args)
+        tree.start()
+    tree_class = SelfPlayTree
+    if tree_args.pop('compact', False):
+        tree_class = CompactSelfPlayTree
+    if tree_args.pop('persistent', False):
+        tree_args['executor'] = SearchExecutor(tree_args.get('threads', 6))
+
+    search_stats = SearchStats()
+    nodes = 0
+    start = timer()
+    for _ in range(searches):
+        if processes > 0:
+            tree.reroot(game)
+        else:
+            tree = tree_class(game, **tree_args)
+        tree.search_move(agent, max_iters=max_iters, max_time=max_time,
+                         early_stop=early_stop, stats=stats)
+        # Some selections may be discarded (collisions), so we count the
+        # visits of the root instead of the iterations.
+        nodes += tree.search_info['iterations']
+        if stats:
+            search_stats.merge(tree.search_info['stats'])
+    elapsed = timer() - start
+    if processes > 0:
+        tree.close()
+    if 'executor' in tree_args:
+        tree_args['executor'].shutdown()
+
+    agent.disconnect()
+    result_placeholder['nps'] = nodes / elapsed
+    result_placeholder['iters'] = nodes / searches
+    if stats:
+        result_placeholder['stats'] = search_stats
+
+
+def run_search(endpoint, searches=3, max_iters=200, max_time=None,
+               early_stop=False, stats=False, **tree_args):
+    """ Runs search_job on a new process and returns its results. """
+    manager = multiprocessing.Manager()
+    return_dict = manager.dict()
+    proc = multiprocessing.Process(target=search_job,
+                                   args=(endpoint, return_dict, searches,
+                                         max_iters, tree_args, max_time,
+                                         early_stop, stats))
+    proc.start()
+    proc.join()
+    return dict(return_dict)
+
+
+def bench_batch_sizes(endpoint, sizes, threads=6, compact=False, searches=3,
+                      max_iters=200, max_time=None, early_stop=False,
+                      stats=False):
+    """ Measures the nodes/sec of the search for several batch sizes (leaves
+    evaluated at once by each thread). With stats=True the SearchStats of
+    the searches of each size are logged too.
+
+    Returns:
+        results: dict. batch size -> nodes/sec.
+    """
+    logger = Logger.get_instance()
+    results = {}
+    for k in sizes:
+        res = run_search(endpoint, searches=searches, max_iters=max_iters,
+                         max_time=max_time, early_stop=early_stop,
+                         stats=stats, threads=threads, compact=compact,
+                         batch_size=k)
+        results[k] = res['nps']
+        logger.info(f"Batch size {k}: {round(results[k], 2)} nodes/sec, "
+                    f"{round(res['iters'])} iterations per search")
+        if stats:
+            logger.info(f"Search stats:\n{res['stats']}")
+    return results
+
+
+def bench_parallel(endpoint, max_workers, compact=False, searches=3,
+                   max_iters=200):
+    """ Measures the nodes/sec of the threaded search (one tree with 1..N
+    threads) and the root parallel one (1..N processes with a thread each).
+
+    Returns:
+        results: dict. 'threads'/'processes' -> list of nodes/sec (one for
+        each number of workers).
+    """
+    logger = Logger.get_instance()
+    results = {'threads': [], 'processes': []}
+    for n in range(1, max_workers + 1):
+        for mode in results.keys():
+            tree_args = {'threads': n}
+            if mode == 'processes':
+                tree_args = {'threads': 1, 'processes': n}
+            res = run_search(endpoint, searches=searches, max_iters=max_iters,
+                             compact=compact, **tree_args)
+            results[mode].append(res['nps'])
+            logger.info(f"{n} {mode}: {round(res['nps'], 2)} nodes/sec")
+    return results
+
+
+def bench_scheduling(endpoint, threads=6, searches=20, max_iters=None):
+    """ Measures the time per move of short searches (by default one
+    iteration per thread) when each search starts its own threads and when
+    all of them use the same SearchExecutor.
+
+    Returns:
+        results: dict. 'per search'/'persistent' -> ms per move.
+    """
+    logger = Logger.get_instance()
+    if max_iters is None:
+        max_iters = threads
+    results = {}
+    for name, persistent in (('per search', False), ('persistent', True)):
+        res = run_search(endpoint, searches=searches, max_iters=max_iters,
+                         threads=threads, persistent=persistent)
+        results[name] = 1000 * res['iters'] / res['nps']
+        logger.info(f"Threads {name}: {round(results[name], 2)} ms/move")
+    return results
+
+
+def _legacy_best_child(node):
+    """ Child selection as it was made before the stats arrays of Node: the
+    get_value() of every child, each one summing the visits of its children.
+    """
+    values = [(c.value / (1 + c.visits)) + PUCT_C * c.prior *
+              np.sqrt(np.sum([g.visits for g in c.children])) /
+              (1 + c.visits) - c.vloss
+              for c in node.children]
+    return node.children[np.argmax(values)]
+
+
+def bench_selection(fen=WIDE_FEN, grandchildren=20, repetitions=5000):
+    """ Measures the child selections per second on the root of a wide
+    position whose children have random stats. Compares the original
+    selection with the vectorized ones of Node and CompactSelfPlayTree.
+
+    Parameters:
+        fen: str. Position of the root.
+        grandchildren: int. Max. number of children of each child of the
+        root.
+        repetitions: int. Selections made with each method.
+    Returns:
+        results: dict. method -> selections/sec.
+    """
+    logger = Logger.get_instance()
+    rng = np.random.RandomState(0)
+    game = Game(board=chess.Board(fen))
+
+    root = Node(game)
+    for move in game.get_legal_moves():
+        state = game.get_copy()
+        state.move(move)
+        child = Node(state, parent=root)
+        root.add_child(child)
+        for _ in range(min(grandchildren, child.num_actions)):
+            grandchild = Node(state, parent=child)
+            child.add_child(grandchild)
+            grandchild.visits = rng.randint(1, 20)
+            grandchild.sync()
+            child.children_visits += grandchild.visits
+        child.visits = child.children_visits + 1
+        child.value = rng.uniform(-1, 1) * child.visits
+        child.prior = rng.uniform()
+        child.sync()
+        root.children_visits += child.visits
+
+    tree = CompactSelfPlayTree(game)
+    tree.expand(tree.ROOT, priors=[c.prior for c in root.children],
+                state=game)
+    children = tree.store.children(tree.ROOT)
+    tree.store.visits[children] = [c.visits for c in root.children]
+    tree.store.value[children] = [c.value for c in root.children]
+    tree.store.child_visits[children] = [c.children_visits
+                                         for c in root.children]
+
+    methods = {'original': lambda: _legacy_best_child(root),
+               'vectorized (Node)': root.get_best_child,
+               'vectorized (NodeStore)':
+               lambda: tree._best_child(tree.ROOT)}
+    results = {}
+    logger.info(f"Root with {len(root.children)} children")
+    for name, select in methods.items():
+        start = timer()
+        for _ in range(repetitions):
+            select()
+        results[name] = repetitions / (timer() - start)
+        logger.info(f"{name}: {round(results[name])} selections/sec")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the throughput "
+                                     "of the tree search.")
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    batch_parser = subparsers.add_parser('batch', help="Nodes/sec for "
+                                         "several batch sizes.")
+    batch_parser.add_argument('--model', metavar='model', default=None,
+                              help="Path to the model weights (.h5). A fresh "
+                              "model is used if not given.")
+    batch_parser.add_argument('--iters', metavar='iters', type=int,
+                              default=200)
+    batch_parser.add_argument('--searches', metavar='searches', type=int,
+                              default=3)
+    batch_parser.add_argument('--threads', metavar='threads', type=int,
+                              default=6)
+    batch_parser.add_argument('--batch-sizes', metavar='batch_sizes',
+                              type=int, nargs='+', default=[1, 4, 8, 16])
+    batch_parser.add_argument('--compact',
+                              action='store_true',
+                              default=False,
+                              help="Use CompactSelfPlayTree. Default false.")
+    batch_parser.add_argument('--max-time', metavar='max_time', type=float,
+                              default=None,
+                              help="Max. seconds of each search.")
+    batch_parser.add_argument('--early-stop',
+                              action='store_true',
+                              default=False,
+                              help="Stop the searches once their best move "
+                              "can't change. Default false.")
+    batch_parser.add_argument('--stats',
+                              action='store_true',
+                              default=False,
+                              help="Log the stats of the searches (time of "
+                              "each phase, depth, lock contention...). "
+                              "Default false.")
+
+    selection_parser = subparsers.add_parser('selection', help="Child "
+                                             "selections/sec on a wide node.")
+    selection_parser.add_argument('--fen', metavar='fen', default=WIDE_FEN)
+    selection_parser.add_argument('--repetitions', metavar='repetitions',
+                                  type=int, default=5000)
+
+    parallel_parser = subparsers.add_parser('parallel', help="Nodes/sec of "
+                                            "the threaded and root parallel "
+                                            "searches.")
+    parallel_parser.add_argument('--model', metavar='model', default=None,
+                                 help="Path to the model weights (.h5). A "
+                                 "fresh model is used if not given.")
+    parallel_parser.add_argument('--iters', metavar='iters', type=int,
+                                 default=200)
+    parallel_parser.add_argument('--searches', metavar='searches', type=int,
+                                 default=3)
+    parallel_parser.add_argument('--workers', metavar='workers', type=int,
+                                 default=multiprocessing.cpu_count(),
+                                 help="Max. number of threads/processes.")
+    parallel_parser.add_argument('--compact',
+                                 action='store_true',
+                                 default=False,
+                                 help="Use CompactSelfPlayTree. Default "
+                                 "false.")
+
+    scheduling_parser = subparsers.add_parser('scheduling', help="Time per "
+                                              "move of short searches.")
+    scheduling_parser.add_argument('--model', metavar='model', default=None,
+                                   help="Path to the model weights (.h5). A "
+                                   "fresh model is used if not given.")
+    scheduling_parser.add_argument('--iters', metavar='iters', type=int,
+                                   default=None,
+                                   help="Iterations of each search (one per "
+                                   "thread by default).")
+    scheduling_parser.add_argument('--searches', metavar='searches',
+                                   type=int, default=20)
+    scheduling_parser.add_argument('--threads', metavar='threads', type=int,
+                                   default=6)
+
+    args = parser.parse_args()
+
+    logger = Logger.get_instance()
+    logger.set_level(1)
+
+    if args.benchmark == 'selection':
+        bench_selection(fen=args.fen, repetitions=args.repetitions)
+        return
+
+    # The searches run on new processes, they don't need the TF state of this
+    # one.
+    multiprocessing.set_start_method('spawn', force=True)
+
+    endpoint = ('localhost', 9999)
+    worker = PredictWorker(model_path=args.model, endpoint=endpoint)
+    worker.start()
+    try:
+        if args.benchmark == 'parallel':
+            bench_parallel(endpoint, args.workers, compact=args.compact,
+                           searches=args.searches, max_iters=args.iters)
+        elif args.benchmark == 'scheduling':
+            bench_scheduling(endpoint, threads=args.threads,
+                             searches=args.searches, max_iters=args.iters)
+        else:
+            bench_batch_sizes(endpoint, args.batch_sizes,
+                              threads=args.threads, compact=args.compact,
+                              searches=args.searches, max_iters=args.iters,
+                              max_time=args.max_time,
+                              early_stop=args.early_stop, stats=args.stats)
+    finally:
+        worker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -18,10 +18,15 @@ class DatasetGame(object):
         if games is not None:
             self.games = games
 
-    def augment_game(self, game_base):
+    def augment_game(self, game_base, encoded_history=None):
         """ Expands a game. For the N movements of a game, it creates
         N games with each state + the final result of the original game +
         the next movement (in each state).
+
+        Parameters:
+            game_base: Game. Game to expand.
+            encoded_history: EncodedHistory. History of the initial position
+            (see netencoder). If given, the games keep theirs.
         """
         hist = game_base.get_history()
         moves = hist['moves']
@@ -31,7 +36,8 @@ class DatasetGame(object):
 
         augmented = []
 
-        g = game.Game(date=date, player_color=p_color)
+        g = game.Game(date=date, player_color=p_color,
+                      encoded_history=encoded_history)
 
         for m in moves:
             augmented.append({'game': g,
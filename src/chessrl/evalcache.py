@@ -0,0 +1,103 @@
+"""
+Cache of the predictions of the neural net. The searches ask for the same
+positions over and over (the opening, transpositions, the policy of a node
+which has just been evaluated...), so the agents keep the latest predictions
+and only send the positions they haven't seen to the network.
+"""
+
+import numpy as np
+
+from collections import OrderedDict
+from threading import Lock
+
+
+# Approx. bytes taken by each entry besides its policy array (key bytes,
+# value, OrderedDict node)
+ENTRY_OVERHEAD = 400
+
+
+class EvaluationCache(object):
+    """ Bounded cache of (policy, value) predictions keyed by the packed
+    input of the network (see netencoder.pack_games), which holds the
+    position and the history seen by the network in 218 bytes. When it's
+    full, the least recently used entry is evicted. It's
+    thread-safe, so the copies of an agent can share it.
+
+    Note that the entries are only valid for the weights that computed them,
+    clear() it after loading new ones.
+
+    Attributes:
+        max_size: int. Max. number of entries.
+        hits: int. Number of lookups which found the prediction.
+        misses: int. Number of lookups which didn't find it.
+        evictions: int. Number of evicted entries.
+    """
+    def __init__(self, max_size=20000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.policy_bytes = 0
+
+    def lookup(self, key):
+        """ Returns the (policy, value) stored for a key (None if it's not
+        in the cache).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, policy, value):
+        """ Adds a prediction to the cache.
+
+        Parameters:
+            key: bytes. Packed input of the game (see
+            netencoder.pack_games).
+            policy: np.array. Policy over all the moves.
+            value: float. Predicted value.
+        """
+        # Copy, so a view doesn't keep the whole batch of the prediction
+        policy = np.array(policy)
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (policy, value)
+            self.policy_bytes += policy.nbytes
+            if len(self.entries) > self.max_size:
+                _, (old_policy, _) = self.entries.popitem(last=False)
+                self.policy_bytes -= old_policy.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        """ Removes all the entries (the counters are kept). """
+        with self.lock:
+            self.entries = OrderedDict()
+            self.policy_bytes = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    @property
+    def nbytes(self):
+        """ Approx. memory used by the entries (in bytes). """
+        return self.policy_bytes + ENTRY_OVERHEAD * len(self.entries)
+
+    def stats(self):
+        """ Returns a dict with the size, hits, misses, evictions, hit rate
+        and memory (bytes) of the cache.
+        """
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hit_rate,
+                'nbytes': self.nbytes}
+
+    def __len__(self):
+        return len(self.entries)
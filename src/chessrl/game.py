@@ -14,7 +14,8 @@ class Game(object):
     WHITE = chess.WHITE
     BLACK = chess.BLACK
 
-    def __init__(self, board=None, player_color=chess.WHITE, date=None):
+    def __init__(self, board=None, player_color=chess.WHITE, date=None,
+                 encoded_history=None):
         if board is None:
             self.board = chess.Board()
         else:
@@ -25,6 +26,9 @@ class Game(object):
         if self.date is None:
             self.date = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
+        # Encoded positions for the network (see netencoder.track_history)
+        self.encoded_history = encoded_history
+
     def move(self, movement):
         """ Makes a move.
         Params:
@@ -36,10 +40,19 @@ class Game(object):
         # move stack before launching the exception
         success = False
         if movement in self.get_legal_moves():
-            self.board.push(chess.Move.from_uci(movement))
+            self.push(chess.Move.from_uci(movement))
             success = True
         return success
 
+    def push(self, move):
+        """ Makes a move without checking whether it's legal.
+        Params:
+            move: chess.Move. Legal move.
+        """
+        self.board.push(move)
+        if self.encoded_history is not None:
+            self.encoded_history = self.encoded_history.push(self.board)
+
     def get_legal_moves(self, final_states=False):
         """ Gets a list of legal moves in the current turn.
         Parameters:
@@ -77,7 +90,8 @@ class Game(object):
         return self.board.turn
 
     def get_copy(self):
-        return Game(board=self.board.copy())
+        return Game(board=self.board.copy(),
+                    encoded_history=self.encoded_history)
 
     def reset(self):
         self.board.reset()
@@ -33,12 +33,12 @@ class GameStockfish(Game):
         # If stockfish moves first
         if self.stockfish.color and len(self.board.move_stack) == 0:
             stockfish_best_move = self.stockfish.best_move(self)
-            self.board.push(chess.Move.from_uci(stockfish_best_move))
+            self.push(chess.Move.from_uci(stockfish_best_move))
         else:
             made_movement = super().move(movement)
             if made_movement and self.get_result() is None:
                 stockfish_best_move = self.stockfish.best_move(self)
-                self.board.push(chess.Move.from_uci(stockfish_best_move))
+                self.push(chess.Move.from_uci(stockfish_best_move))
 
     def get_copy(self):
         return GameStockfish(board=self.board.copy(), stockfish=self.stockfish)
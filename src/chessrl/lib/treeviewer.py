@@ -1,9 +1,11 @@
 from mctree import Tree, Node
+from treesnapshot import TreeSnapshot
 
 import networkx as nx
 from networkx.drawing.nx_agraph import graphviz_layout
 from matplotlib import pyplot as plt
 
+import json
 import tempfile
 import webbrowser
 import os
@@ -65,6 +67,54 @@ def draw_tree_html(tree: Tree):
     webbrowser.open('file://{}'.format(path))
 
 
+def draw_snapshot_html(snapshot, k=3, depth=3):
+    """ Plots the most visited part of a tree snapshot on the browser. Only
+    the k most visited children of each node are drawn, down to the given
+    depth, so it also works with large searches.
+
+    Parameters:
+        snapshot: TreeSnapshot or str. Snapshot (or path of the file).
+        k: int. Children of each node.
+        depth: int. Levels of the tree.
+    """
+    if not isinstance(snapshot, TreeSnapshot):
+        snapshot = TreeSnapshot(snapshot)
+    template_path = os.path.abspath(__file__ + "/../") + \
+        "/static/template.html"
+
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    path = tmp.name + '.html'
+
+    with open(template_path, 'r') as file:
+        filestr = file.read()
+
+    tree_json = __snapshot_json(snapshot.top_k(k, depth), root=True)
+    filestr = filestr.replace("{_DATA_}", json.dumps(tree_json))
+
+    with open(path, 'w') as file:
+        file.write(filestr)
+
+    webbrowser.open('file://{}'.format(path))
+
+
+def __snapshot_json(node, root=False):
+    move = '[ROOT]' if root else node['move']
+    if node['reply'] is not None:
+        move += f" {node['reply']}"
+    node_json = {'text': {'title': f"N: {node['visits']}",
+                          'name': f"Q: {node['q']:.3f}",
+                          'desc': f"Move: {move} P: {node['prior']:.3g}"},
+                 'children': [__snapshot_json(c) for c in node['children']]}
+
+    if len(node['children']) > 0:
+        if root:
+            # The children are sorted by visits
+            node_json['children'][0]['HTMLclass'] = 'nextmove'
+        chosen = np.argmax([c['q'] for c in node['children']])
+        node_json['children'][chosen]['HTMLclass'] = 'maxnode'
+    return node_json
+
+
 def __json(node, root=False):
     node_json = {}
     if root:
@@ -1,40 +1,200 @@
+import asyncio
+import math
 import numpy as np
+import chess
+
+import netencoder
+import nodestore
 
 from game import Game
 from player import Player
+from nodestore import NodeStore
+from searchstats import SearchStats
+from transposition import position_key
 
-from concurrent.futures import ThreadPoolExecutor
-from threading import Lock
+from concurrent.futures import Future
+from contextlib import nullcontext
+from queue import Queue
+from threading import Condition, Lock, RLock, Thread, local
 
 from timeit import default_timer as timer
 
 
 VIRTUAL_LOSS = 1
+PUCT_C = 10  # Weight of the exploration term (U) of the PUCT formula
+# Nodes with at least these visits keep their game instead of rebuilding it
+STATE_CACHE_VISITS = 8
+# A tree over its node cap is pruned down to this fraction of the cap
+PRUNE_RATIO = 0.8
+
+# Approx. memory of a Node (without its arrays) and of a Game (plus each move
+# of its stack and its EncodedHistory), used to report the footprint of the
+# trees
+NODE_BYTES = 640
+GAME_BYTES = 900
+MOVE_BYTES = 190
+HISTORY_BYTES = 1100
+
+# Phase of the searches without stats
+NO_PHASE = nullcontext()
+
+
+def _game_bytes(game):
+    """ Approx. memory used by a game. """
+    nbytes = GAME_BYTES + MOVE_BYTES * len(game.board.move_stack)
+    if game.encoded_history is not None:
+        nbytes += HISTORY_BYTES
+    return nbytes
 
 
 class Node(object):
-    """ Node from a Monte Carlo Tree.
+    """ Node from a Monte Carlo Tree. The nodes only store the moves which
+    lead to them from their parent. Their game is rebuilt (pushing the moves
+    from the closest ancestor which keeps its game) when it's needed, and
+    only the root and the most visited nodes keep it.
+
+    Parameters:
+        state: Game. Game at the node. It's kept by the node.
+        parent: Node. Parent node.
+        move: chess.Move. Move which leads from the parent to the node.
+        reply: chess.Move. Opponent reply after `move` (None if the game
+        ended with `move`).
+        result: int. Result of the game at the node (None if it's not over).
+        It's computed from the state if it's given.
 
     Attributes:
-        state: Game. Game in a certain state.
+        state: Game. Game in a certain state (see the state property).
         children: Array. Possible game states after applying the legal moves to
         the current state.
+        unexpanded_actions: list. Legal moves (UCI) without a child yet. It's
+        computed the first time it's needed.
+        num_actions: int. Number of legal moves of the state.
         parent: Node. Parent state of the current game.
         value: float. Expected reward of this node.
         visits: int. Number of times the node has been visited
         prior: float.
+        policy: list. Prior probabilities of the legal moves of the state,
+        predicted with its value when the node was evaluated. They're used
+        to expand the node instead of asking the agent again, and dropped
+        once the priors of its children are set.
+        priors_set: bool. Whether the priors of the children have been set
+        from the policy (a later evaluation of the node doesn't keep it).
+        predicted_value: float. Value predicted with the policy when the
+        node needed it to be expanded before its own evaluation arrived
+        (progressive widening). It's used by the evaluation instead of
+        predicting the node again.
+        action_priors: list. Priors of the unexpanded_actions when they're
+        sorted to be expanded in descending prior order (progressive
+        widening), None otherwise.
+        replies: dict. Opponent reply (chess.Move, None if the game ends
+        with our move) to each legal move (UCI). They're computed at once
+        when the node starts being expanded and dropped when it's done.
+        key: int. Zobrist hash of the state (only when the tree uses a
+        transposition table).
+        expanding: bool. Whether a search thread is creating a child of the
+        node (see SelfPlayTree.select).
+        children_visits: int. Sum of the visits of the children.
+        index: int. Position of the node in the children of its parent.
+        edge_visits, edge_values, edge_priors, edge_vloss,
+        edge_children_visits: arrays. Copies of the stats of the children
+        (one position per child), so the PUCT values of all of them are
+        computed at once. They're created with the first child.
+        lock: RLock. Lock of the stats and children of the node. It's
+        reentrant because the legal moves (unexpanded_actions) are computed
+        under it the first time they're read, which may happen while it's
+        held (e.g. when SelfPlayTree claims the node).
     """
 
-    def __init__(self, state: 'Game', parent=None):
-        self.state = state
+    def __init__(self, state: 'Game' = None, parent=None, move=None,
+                 reply=None, result=None):
+        self._state = state
+        self.move = move
+        self.reply = reply
+        self.result = result
+        if state is not None:
+            self.result = state.get_result()
         self.children = []
-        self.unexpanded_actions = state.get_legal_moves()
+        self._unexpanded_actions = None
+        self._num_actions = 0
         self.parent = parent
         self.value = 0
         self.visits = 0
         self.prior = 1
+        self.policy = None
+        self.priors_set = False
+        self.predicted_value = None
+        self.action_priors = None
+        self.replies = None
+        self.key = None
+        self.expanding = False
         self.vloss = 0
-        self.lock = Lock()
+        self.children_visits = 0
+        self.index = 0
+        self.edge_visits = None
+        self.edge_values = None
+        self.edge_priors = None
+        self.edge_vloss = None
+        self.edge_children_visits = None
+        self.lock = RLock()
+
+    @property
+    def state(self):
+        """ Game at the node. If the node doesn't keep it, it's rebuilt from
+        the closest ancestor that does (and kept if the node has enough
+        visits). Must not be modified, use get_state_copy() for that.
+        """
+        state = self._state
+        if state is None:
+            state = self.get_state_copy()
+            if self.visits >= STATE_CACHE_VISITS:
+                self._state = state
+        return state
+
+    def get_state_copy(self):
+        """ Returns a new game at the node. """
+        path = []
+        node = self
+        while node._state is None:
+            path.append(node)
+            node = node.parent
+        state = node._state.get_copy()
+        for n in reversed(path):
+            state.push(n.move)
+            if n.reply is not None:
+                state.push(n.reply)
+        return state
+
+    def keep_state(self, state=None):
+        """ Makes the node keep its game.
+
+        Parameters:
+            state: Game. Game at the node (it's rebuilt if not given).
+        """
+        if state is None:
+            state = self.state
+        self._state = state
+
+    def release_state(self):
+        """ Drops the game of the node unless it's the root or a node with
+        enough visits.
+        """
+        if self.parent is not None and self.visits < STATE_CACHE_VISITS:
+            self._state = None
+
+    @property
+    def unexpanded_actions(self):
+        if self._unexpanded_actions is None:
+            with self.lock:
+                if self._unexpanded_actions is None:
+                    actions = self.state.get_legal_moves()
+                    self._num_actions = len(actions)
+                    self._unexpanded_actions = actions
+        return self._unexpanded_actions
+
+    @property
+    def num_actions(self):
+        self.unexpanded_actions
+        return self._num_actions
 
     @property
     def is_leaf(self):
@@ -46,7 +206,7 @@ class Node(object):
 
     @property
     def is_terminal_state(self):
-        return self.state.get_result() is not None
+        return self.result is not None
 
     @property
     def is_root(self):
@@ -55,6 +215,81 @@ class Node(object):
     def pop_unexpanded_action(self):
         return self.unexpanded_actions.pop()
 
+    def add_child(self, child):
+        """ Appends a child to the node and copies its stats to the arrays.
+        """
+        num_actions = self.num_actions
+        with self.lock:
+            if self.edge_visits is None:
+                self.edge_visits = np.zeros(num_actions)
+                self.edge_values = np.zeros(num_actions)
+                self.edge_priors = np.zeros(num_actions)
+                self.edge_vloss = np.zeros(num_actions)
+                self.edge_children_visits = np.zeros(num_actions)
+            child.index = len(self.children)
+            self.children.append(child)
+        child.sync()
+
+    def sync(self):
+        """ Copies the stats of the node to the arrays of its parent. Must be
+        called after modifying them.
+        """
+        parent = self.parent
+        if parent is not None:
+            i = self.index
+            parent.edge_visits[i] = self.visits
+            parent.edge_values[i] = self.value
+            parent.edge_priors[i] = self.prior
+            parent.edge_vloss[i] = self.vloss
+            parent.edge_children_visits[i] = self.children_visits
+
+    def collapse(self):
+        """ Drops the subtree of the node, which becomes unexpanded again.
+        Its own stats (visits, value, children visits...) are kept, and so
+        are the priors of its moves if all of them are known (all the
+        children were created or the node was expanded by prior), so they
+        don't need to be predicted again on the next expansion.
+        Returns:
+            removed: list[Node]. The children that were dropped.
+        """
+        with self.lock:
+            removed = self.children
+            priors = None
+            if self.action_priors is not None:
+                priors = dict(zip(self._unexpanded_actions,
+                                  self.action_priors))
+            elif self._unexpanded_actions is not None and \
+                    len(self._unexpanded_actions) == 0:
+                priors = {}
+            if priors is not None:
+                priors.update((c.move.uci(), c.prior) for c in removed)
+                # In the order of the legal moves, as the evaluations
+                self.policy = [priors[m] for m in self.state.get_legal_moves()]
+            self.children = []
+            self._unexpanded_actions = None
+            self.priors_set = False
+            self.action_priors = None
+            self.replies = None
+            self.edge_visits = None
+            self.edge_values = None
+            self.edge_priors = None
+            self.edge_vloss = None
+            self.edge_children_visits = None
+        return removed
+
+    @property
+    def nbytes(self):
+        """ Approx. memory used by the node (and its game, if it keeps it)
+        """
+        nbytes = NODE_BYTES
+        if self.edge_visits is not None:
+            nbytes += 5 * (self.edge_visits.nbytes + 112)
+        if self.policy is not None:
+            nbytes += 8 * len(self.policy) + 112
+        if self._state is not None:
+            nbytes += _game_bytes(self._state)
+        return nbytes
+
     def get_ucb1(self):
         """ returns the UCB1 metric of the node. """
         C = 2
@@ -76,73 +311,555 @@ class Node(object):
         Being C a constant which makes the U (exploration part of the
         equation) more important.
         """
-        C = 10
         value = 0
         if self.is_root:
             value = 99999999999  # Infinite to avoid division by 0
         else:
             value = (self.value / (1 + self.visits)) +\
-                C * self.prior *\
-                (np.sqrt(np.sum([c.visits for c in self.children])) / (1 + self.visits))  # noqa: E501
+                PUCT_C * self.prior *\
+                (np.sqrt(self.children_visits) / (1 + self.visits))
         return value - self.vloss
 
     def get_best_child(self):
-        """Get the best child of this node.
+        """Get the best child of this node. The Q + U values (see get_value)
+        of all the children are computed at once from the stats arrays.
         Returns:
             best: Node. Child with the max. PUCT value.
         """
-        best = np.argmax([c.get_value() for c in self.children])
+        n = len(self.children)
+        visits = self.edge_visits[:n]
+        values = self.edge_values[:n] / (1 + visits) +\
+            PUCT_C * self.edge_priors[:n] *\
+            np.sqrt(self.edge_children_visits[:n]) / (1 + visits)
+        best = np.argmax(values - self.edge_vloss[:n])
         return self.children[best]
 
 
+class SearchLocal(local):
+    """ Storage of each search thread of a tree """
+    stats = None  # SearchStats of the thread (if it collects them)
+
+
+class SearchBudget(object):
+    """ Limits of a search. The search threads claim the leaves of each
+    exploration until the budget is spent.
+
+    Parameters:
+        tree: Tree. Tree being searched.
+        max_iters: int. Max. number of iterations (evaluated leaves). None for
+        no limit.
+        max_time: float. Max. seconds of the search. None for no limit.
+        early_stop: bool. Whether to stop when the second most visited child
+        of the root can't reach the first one in the remaining iterations
+        (estimated from the search speed if there's a time limit).
+
+    Attributes:
+        stop_reason: str. Why the search stopped: 'iterations', 'time' or
+        'early_stop' (None while it's running).
+    """
+    def __init__(self, tree, max_iters=None, max_time=None, early_stop=False):
+        self.tree = tree
+        self.max_iters = max_iters
+        self.max_time = max_time
+        self.early_stop = early_stop
+        # Leaves evaluated and claimed by the explorations in progress
+        self.leaves = 0
+        self.claimed = 0
+        self.start_visits = tree.root_visits
+        self.start = timer()
+        self.stop_reason = None
+        self.lock = Lock()
+
+    @property
+    def iterations(self):
+        """ Iterations (visits of the root) made since the start. """
+        return self.tree.root_visits - self.start_visits
+
+    @property
+    def elapsed(self):
+        return timer() - self.start
+
+    def claim(self, leaves=1):
+        """ Claims the leaves of one more exploration.
+
+        Parameters:
+            leaves: int. Leaves the exploration wants to evaluate.
+        Returns:
+            claimed: int. Leaves it may evaluate (up to `leaves`), 0 if the
+            budget is spent. They must be given back with done().
+        """
+        with self.lock:
+            if self.stop_reason is None:
+                if self.max_iters is not None and\
+                        self.leaves >= self.max_iters:
+                    self.stop_reason = 'iterations'
+                elif self.max_time is not None and\
+                        self.elapsed >= self.max_time:
+                    self.stop_reason = 'time'
+                elif self.early_stop and self._is_decided():
+                    self.stop_reason = 'early_stop'
+            if self.stop_reason is not None:
+                return 0
+            if self.max_iters is not None:
+                # The rest are claimed by explorations in progress (their
+                # threads claim again the ones they don't evaluate)
+                leaves = min(leaves,
+                             self.max_iters - self.leaves - self.claimed)
+                leaves = max(leaves, 0)
+            self.claimed += leaves
+            return leaves
+
+    def done(self, claimed, evaluated):
+        """ Counts the leaves evaluated by an exploration. The rest of the
+        ones it claimed (e.g. the selections of a batch which collided) go
+        back to the budget.
+        """
+        with self.lock:
+            self.claimed -= claimed
+            self.leaves += evaluated
+
+    def _is_decided(self):
+        """ Whether the most visited child of the root can't be overtaken
+        with the remaining iterations.
+        """
+        visits = self.tree.root_children_visits()
+        if len(visits) < 2:
+            # Only one legal move, nothing to search
+            return len(visits) == 1
+
+        done = self.iterations
+        remaining = []
+        if self.max_iters is not None:
+            remaining.append(self.max_iters - done)
+        if self.max_time is not None and done > 0:
+            elapsed = self.elapsed
+            remaining.append(done / elapsed * (self.max_time - elapsed))
+        if len(remaining) == 0:
+            return False
+
+        second, first = np.partition(visits, -2)[-2:]
+        return first - second > min(remaining)
+
+
+class SearchExecutor(object):
+    """ Long-lived threads which run the searches. Each search hands one task
+    (the search loop of the tree) to each thread, and the threads keep their
+    resources (e.g. the agent copies connected to the PredictWorker) from one
+    search to the next.
+
+    Parameters:
+        threads: int. Number of threads.
+
+    Attributes:
+        local: threading.local. Storage of each thread. Its `agents` dict
+        keeps the agent copies of the thread.
+    """
+    def __init__(self, threads=6):
+        self.num_threads = threads
+        self.tasks = Queue()
+        self.local = local()
+        self.threads = []
+        for i in range(threads):
+            thread = Thread(target=self._work, name=f"search_worker_{i}",
+                            daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        self.local.agents = {}
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, fn, args = task
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        for copy in self.local.agents.values():
+            copy.disconnect()
+
+    def run(self, fn, *args):
+        """ Runs fn(*args) on every thread and waits for all of them. The
+        exceptions raised by fn are raised here.
+        """
+        futures = [Future() for _ in self.threads]
+        for future in futures:
+            self.tasks.put((future, fn, args))
+        return [future.result() for future in futures]
+
+    def get_agent(self, agent):
+        """ Returns the copy of an agent for the calling thread (connected
+        with get_copy() and connect() the first time).
+        """
+        agents = self.local.agents
+        copy = agents.get(id(agent))
+        if copy is None:
+            copy = agent.get_copy()
+            copy.connect()
+            agents[id(agent)] = copy
+        return copy
+
+    def shutdown(self):
+        """ Stops the threads (disconnecting their agent copies). """
+        for _ in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class BatchEvaluator(object):
+    """ Evaluates the game states requested by the coroutines of a search in
+    batches. The coroutines await evaluate() and, once all of them are
+    waiting, the pending games are evaluated with a single call to
+    agent.evaluate_batch().
+
+    Parameters:
+        agent: Player. Agent which makes the predictions.
+
+    Attributes:
+        batches: int. Number of predictions made.
+        evaluated: int. Number of games evaluated.
+    """
+    def __init__(self, agent):
+        self.agent = agent
+        self.pending = []
+        self.running = True
+        self.batches = 0
+        self.evaluated = 0
+
+    async def evaluate(self, game):
+        """ Returns the priors of the legal moves of a game and its value. """
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((game, future))
+        return await future
+
+    async def run(self):
+        """ Predicts the pending games until stop() is called. """
+        while self.running or len(self.pending) > 0:
+            # Let the rest of the coroutines run until they await
+            await asyncio.sleep(0)
+            if len(self.pending) > 0:
+                self._predict()
+
+    def stop(self):
+        self.running = False
+
+    def _predict(self):
+        pending, self.pending = self.pending, []
+        evaluations = self.agent.evaluate_batch([g for g, _ in pending])
+        for (game, future), evaluation in zip(pending, evaluations):
+            future.set_result(evaluation)
+        self.batches += 1
+        self.evaluated += len(pending)
+
+
 class Tree(object):
-    """ Monte Carlo Tree.
+    """ Monte Carlo Tree. Its search runs on a single thread (the explorations
+    are asyncio coroutines) and evaluates the leaves in batches, so it can
+    be used by an Agent with the model in the same process.
 
     Parameters:
         root: Node or Game. Root state of the tree. You can pass a Node object
         with a Game as state or directly the game (it will make the Node).
+        coroutines: int. Number of explorations made at once (i.e. max.
+        size of the batches of the neural net).
+
+    Attributes:
+        search_info: dict. Budget spent by the last search: 'iterations'
+        (evaluated leaves), 'time' (secs) and 'stop_reason' (see
+        SearchBudget).
     """
-    def __init__(self, root):
+    def __init__(self, root, coroutines=8):
         if type(root) is Node:
             self.root = root
         else:
-            self.root = Node(root.get_copy())
+            self.root = Node(netencoder.track_history(root.get_copy()))
 
         self.root.visits = 1
+        self.coroutines = coroutines
+        self.search_info = None
+
+    @property
+    def root_visits(self):
+        return self.root.visits
+
+    def root_children_visits(self):
+        """ Returns the visits of each legal move of the root (0 for the
+        unexpanded ones).
+        """
+        if self.root.edge_visits is None:
+            return np.zeros(0)
+        return self.root.edge_visits
+
+    def reroot(self, game):
+        """ Moves the root of the tree to the descendant matching the game
+        (the root state plus the moves played since then). The statistics of
+        the new root subtree are kept and the rest of the tree is discarded.
+
+        Parameters:
+            game: Game. Current game.
+        Returns:
+            success: bool. Whether the game was found in the tree. If not,
+            the tree isn't modified.
+        """
+        root_moves = self.root.state.board.move_stack
+        played = game.board.move_stack[len(root_moves):]
+        if game.board.move_stack[:len(root_moves)] != root_moves:
+            return False
+
+        path = [self.root]
+        while len(played) > 0:
+            node = path[-1]
+            for c in node.children:
+                edge = [c.move] if c.reply is None else [c.move, c.reply]
+                if played[:len(edge)] == edge:
+                    path.append(c)
+                    played = played[len(edge):]
+                    break
+            else:
+                return False
+
+        # The new root must keep its game before unlinking its ancestors
+        path[-1].keep_state()
+        # Unlink the discarded part of the tree
+        for node in path[:-1]:
+            node.children = []
+        self.root = path[-1]
+        self.root.parent = None
+        self.root.visits = max(self.root.visits, 1)
+        return True
 
     def search_move(self, agent, max_iters=200, verbose=False, noise=True,
-                    ai_move=False):
+                    ai_move=False, max_time=None, early_stop=False):
         """ Explores and selects the best next state to choose from the root
-        state
+        state. The search runs `coroutines` explorations at once on an
+        asyncio loop. They await the evaluations of their leaves, which are
+        made in batches by a BatchEvaluator.
 
         Parameters:
             agent: Player. Agent which will be used in the simulations agaisnt
-            stockfish (the neural network).
-            max_iters: int. Number of interations to run the algorithm.
+            stockfish (the neural network). It must implement evaluate_batch.
+            max_iters: int. Number of interations to run the algorithm. The
+            visits of the root made in previous searches (if the tree has been
+            rerooted) are discounted. None for no limit (max_time must be
+            given then).
             verbose: bool. Whether to print the search status.
             noise: bool. Whether to add Dirichlet noise to the calc policy.
             ai_move: bool. Whether to return the move that AI will make after
             our best move
+            max_time: float. Max. seconds of the search.
+            early_stop: bool. Whether to stop once the best move can't change
+            in the remaining budget.
         """
-        pass
+        if max_iters is None and max_time is None:
+            raise ValueError("The search needs max_iters or max_time")
+        if max_iters is not None:
+            max_iters = max(max_iters - (self.root_visits - 1), 0)
+        budget = SearchBudget(self, max_iters=max_iters, max_time=max_time,
+                              early_stop=early_stop)
+        evaluator = BatchEvaluator(agent)
 
-    def explore_tree(self, node, agent, verbose=False):
-        pass
+        async def search():
+            evaluation = asyncio.ensure_future(evaluator.run())
+            try:
+                await asyncio.gather(*[self._search_worker(budget, evaluator)
+                                       for _ in range(self.coroutines)])
+            finally:
+                evaluator.stop()
+                await evaluation
 
-    def select(self, node, agent):
-        pass
+        asyncio.run(search())
+        self.search_info = {'iterations': budget.iterations,
+                            'time': budget.elapsed,
+                            'stop_reason': budget.stop_reason}
+        if verbose:
+            print(f"Search: {self.search_info}, "
+                  f"{evaluator.batches} batches")
 
-    def expand(self, node, agent=None):
-        pass
+        max_val = np.argmax(self.compute_policy(self.root, noise=noise))
+        moves = self.get_child_moves(max_val)
 
-    def simulate(self, node: Node, agent: Player):
-        pass
+        if not ai_move:
+            moves = moves[0]
+        return moves
+
+    def get_child_moves(self, index):
+        """ Returns the moves (UCI) which lead from the root to one of its
+        children: our move and the move the AI made after it.
+
+        Parameters:
+            index: int. Position of the child in the root children.
+        """
+        child = self.root.children[index]
+        b_mov = child.move.uci()
+        # The agent move which will be made after the last one of ours (null
+        # if the game ended with ours).
+        agent_last_mov = Game.NULL_MOVE
+        if child.reply is not None:
+            agent_last_mov = child.reply.uci()
+
+        return b_mov, agent_last_mov
+
+    async def _search_worker(self, budget, evaluator):
+        """ Explores the tree until the budget is spent. """
+        while budget.claim():
+            leaf = await self.select(self.root, evaluator)
+            value = await self.simulate(leaf, evaluator)
+            self.backprop(leaf, value, remove_vloss=True)
+            leaf.release_state()
+            budget.done(1, 1)
+
+    async def select(self, node, evaluator):
+        current_node = node
+        while not current_node.is_terminal_state:
+            if not current_node.is_fully_expanded:
+                current_node = await self.expand(current_node, evaluator)
+                break
+            elif current_node.is_leaf:
+                # Its only children are still being expanded by other
+                # explorations, so it's evaluated again.
+                break
+            else:
+                current_node = current_node.get_best_child()
+
+        current_node.vloss += VIRTUAL_LOSS
+        current_node.sync()
+        return current_node
+
+    async def expand(self, node, evaluator=None):
+        """ Adds a child to the node (the game after one of its legal moves
+        and the reply of the opponent, the move with the highest prior).
+        When all the children have been added, their priors are set.
+
+        Parameters:
+            node: Node. Node which will be expanded.
+            evaluator: BatchEvaluator. Used for the opponent move.
+        Returns:
+            child: Node. New child.
+        """
+        move = chess.Move.from_uci(node.pop_unexpanded_action())
+        new_state = node.get_state_copy()
+        new_state.push(move)
+        reply = None
+        result = new_state.get_result()
+        if result is None:
+            priors, _ = await evaluator.evaluate(new_state)
+            reply = list(new_state.board.legal_moves)[np.argmax(priors)]
+            new_state.push(reply)
+            result = new_state.get_result()
+
+        new_child = Node(parent=node, move=move, reply=reply, result=result)
+        # Kept until the child is evaluated
+        new_child.keep_state(new_state)
+        node.add_child(new_child)
+
+        if len(node.children) == node.num_actions:
+            if node.policy is not None:
+                self._set_priors(node, node.policy)
+            elif not self._evaluation_pending(node):
+                # Only the root isn't evaluated before being expanded
+                priors, _ = await evaluator.evaluate(node.state)
+                self._set_priors(node, priors)
+            # Otherwise they're set when its evaluation arrives
+        return new_child
+
+    def _set_priors(self, node, priors):
+        """ Sets the priors of the children of a node (all of them created)
+        from its policy and drops the policy. It's done once per node.
+
+        Parameters:
+            node: Node. Fully expanded node.
+            priors: list. Priors of the legal moves of the node.
+        """
+        if node.priors_set:
+            return
+        node.priors_set = True
+        node.policy = None
+        # The children may have been added in any order (their
+        # expansions await the opponent moves)
+        priors = dict(zip(node.state.get_legal_moves(), priors))
+        for n in node.children:
+            n.prior = priors[n.move.uci()]
+            n.sync()
+
+    def _keep_policy(self, node, policy):
+        """ Keeps the policy of an evaluated node for the expansion. If all
+        its children were created while it was evaluated, their priors are
+        set now; if they were already set, it isn't kept.
+        """
+        if node.priors_set:
+            return
+        if len(node.children) > 0 and \
+                len(node.children) == node.num_actions:
+            self._set_priors(node, policy)
+        else:
+            node.policy = policy
+
+    def _evaluation_pending(self, node):
+        """ Whether a node is waiting for its first evaluation (it was
+        created by an exploration which hasn't evaluated it yet).
+        """
+        return node.visits == 0 and node.parent is not None and \
+            node.result is None
+
+    async def simulate(self, node: Node, evaluator):
+        """ Evaluates a node with the neural net (the priors of its legal
+        moves are kept in the node to be used when it's fully expanded).
+
+        Parameters:
+            node: Node. Game state from which the simulation will be run.
+            evaluator: BatchEvaluator. Evaluator of the game states.
+        Returns:
+            results_sim: float, Result of the game/predicted value from NN.
+        """
+        result = node.result
+        if result is None:
+            policy, result = await evaluator.evaluate(node.state)
+            self._keep_policy(node, policy)
+        return result
 
     def backprop(self, node: Node, value: float, remove_vloss=False):
-        pass
+        """ Backpropagation phase of the algorithm.
+
+        Parameters:
+            node: Node. that will be added 1 to vi and the value obtained in
+                the simulation process.
+            value: float, value that will be added to all of the ancestors
+                untill root.
+            remove_vloss: Remove virtual loss from the node (only the leaf
+                of the exploration has it).
+        """
+        node.visits += 1
+        node.value += value
+        if remove_vloss:
+            node.vloss -= VIRTUAL_LOSS
+        node.sync()
+
+        if node.parent is not None:
+            node.parent.children_visits += 1
+            self.backprop(node.parent, value)
 
     def compute_policy(self, node: Node, noise=True):
-        pass
+        """ Calculates the policy vector given a game state """
+        # Select tau = 1 -> 0 (if number of moves > 30)
+        nb_moves = len(node.state.board.move_stack)
+        tau = 1
+        if nb_moves >= 30:
+            tau = nb_moves / (1 + np.power(nb_moves, 1.3))
+
+        # Select argmax π(a|node) proportional to the visit count
+        policy = np.array([np.power(v.visits, 1 / tau) for v in node.children])\
+            / np.power(node.visits, 1 / tau)
+
+        # apply random noise for ensuring exploration
+        if noise:
+            epsilon = 0.25
+            policy = (1 - epsilon) * policy +\
+                np.random.dirichlet([0.03] * len(node.children))
+        return policy
 
 
 class SelfPlayTree(Tree):
@@ -151,80 +868,357 @@ class SelfPlayTree(Tree):
     Parameters:
         root: Node or Game. Root state of the tree. You can pass a Node object
         with a Game as state or directly the game (it will make the Node).
+        threads: int. Number of threads used in the search.
+        batch_size: int. Number of leaves each thread selects (under virtual
+        loss) before sending all of them to the neural net in a single
+        request. 1 evaluates every leaf on its own.
+        transpositions: TranspositionTable. If given, the leaves whose
+        position is in the table reuse its evaluation/stats instead of asking
+        the neural net. It can be shared between searches.
+        root_noise: float. Weight of the Dirichlet noise mixed with the
+        priors of the root children when the root is expanded (0 disables
+        it). Makes independent searches of the same root explore differently.
+        executor: SearchExecutor. Threads which run the searches. If not
+        given, each search starts (and stops) its own threads.
+        max_nodes: int. Max. number of nodes of the tree (None for no
+        limit). When the search goes over it, the explorations are paused
+        and the least visited subtrees are collapsed (see prune()).
+        widening: float. Progressive widening (None disables it). The
+        children of a node are created in descending prior order, and a node
+        with N visits can only have ceil(widening * N^widening_exp) of them.
+        widening_exp: float. Exponent of the progressive widening.
+
+    Attributes:
+        num_nodes: int. Number of nodes of the tree (approximate during a
+        search, it's recounted when the tree is pruned or rerooted).
+        pruned: int. Number of nodes removed by prune().
+        transposition_hits: int. Leaves found in the transposition table
+        during the last search.
+        search_info: dict. Budget spent by the last search: 'iterations'
+        (evaluated leaves), 'time' (secs) and 'stop_reason' (see
+        SearchBudget), and the 'nodes' of the tree after it. Searches with stats=True also have the SearchStats
+        of the search in 'stats'.
     """
-    def __init__(self, root, threads=6):
+    def __init__(self, root, threads=6, batch_size=1, transpositions=None,
+                 root_noise=0, executor=None, max_nodes=None, widening=None,
+                 widening_exp=0.5):
         super().__init__(root)
+        self.executor = executor
+        self.widening = widening
+        self.widening_exp = widening_exp
+        self.local = SearchLocal()
+        self.max_nodes = max_nodes
+        self.num_nodes = self._count_nodes()
+        self.pruned = 0
+        # Explorations in progress, paused while the tree is pruned
+        self.explorations = Condition()
+        self.active = 0
+        self.pruning = False
+        # Threads waiting for a node being expanded by another one
+        self.expansions = Condition()
+        self.expansion_waiters = 0
         self.num_threads = threads
+        self.batch_size = batch_size
+        self.transpositions = transpositions
+        self.root_noise = root_noise
+        self.transposition_hits = 0
+        self.search_info = None
 
     def search_move(self, agent, max_iters=200, verbose=False, noise=True,
-                    ai_move=False):
+                    ai_move=False, max_time=None, early_stop=False,
+                    stats=False):
         """ Explores and selects the best next state to choose from the root
         state
 
         Parameters:
             agent: Player. Agent which will be used in the simulations agaisnt
             stockfish (the neural network).
-            max_iters: int. Number of interations to run the algorithm.
+            max_iters: int. Number of interations to run the algorithm. The
+            visits of the root made in previous searches (if the tree has been
+            rerooted) are discounted. None for no limit (max_time must be
+            given then).
             verbose: bool. Whether to print the search status.
             noise: bool. Whether to add Dirichlet noise to the calc policy.
             ai_move: bool. Whether to return the move that AI will make after
             our best move
+            max_time: float. Max. seconds of the search (the explorations in
+            progress are finished). None for no limit.
+            early_stop: bool. Whether to stop once the second most visited
+            move can't reach the first one in the remaining budget.
+            stats: bool. Whether to collect the SearchStats of the search
+            (in search_info['stats']).
         """
-        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
-            for _ in range(max_iters):
-                executor.submit(self.explore_tree, node=self.root, agent=agent,
-                                verbose=verbose)
-
-        max_val = np.argmax(self.compute_policy(self.root, noise=noise))
+        if max_iters is None and max_time is None:
+            raise ValueError("The search needs max_iters or max_time")
+        if max_iters is not None:
+            max_iters = max(max_iters - (self.root_visits - 1), 0)
+        budget = SearchBudget(self, max_iters=max_iters, max_time=max_time,
+                              early_stop=early_stop)
 
-        # After the last play the oponent has played, so we use the before last
-        # one
-        b_mov = Game.NULL_MOVE
-        # The agent move which will be made after the last one of ours.
-        agent_last_mov = Game.NULL_MOVE
+        hits = self.transpositions.hits if self.transpositions else 0
+        executor = self.executor
+        if executor is None:
+            executor = SearchExecutor(self.num_threads)
         try:
-            b_mov = self.root.children[max_val].state.board.move_stack[-2]
-            agent_last_mov = self.root.children[max_val]\
-                .state.board.move_stack[-1]
-        except IndexError:
-            # Should get here if it is not the agent's turn. For example, at
-            # the first turn if the agent plays blacks.
-            pass
+            thread_stats = executor.run(self._search_worker, budget, agent,
+                                        executor, verbose, stats)
+        finally:
+            if self.executor is None:
+                executor.shutdown()
+        if self.transpositions is not None:
+            self.transposition_hits = self.transpositions.hits - hits
+        self.search_info = {'iterations': budget.iterations,
+                            'time': budget.elapsed,
+                            'stop_reason': budget.stop_reason,
+                            'nodes': self.num_nodes}
+        if stats:
+            search_stats = SearchStats()
+            for s in thread_stats:
+                search_stats.merge(s)
+            search_stats.iterations = budget.iterations
+            search_stats.elapsed = self.search_info['time']
+            self.search_info['stats'] = search_stats
+            if verbose:
+                print(search_stats)
 
-        moves = str(b_mov), str(agent_last_mov)
+        max_val = np.argmax(self.compute_policy(self.root, noise=noise))
+        moves = self.get_child_moves(max_val)
 
         if not ai_move:
-            moves = str(b_mov)
+            moves = moves[0]
         return moves
 
+    def _search_worker(self, budget, agent, executor, verbose=False,
+                       stats=False):
+        """ Explores the tree (with the agent copy of the executor thread)
+        until the budget is spent. Returns the SearchStats of the thread (if
+        stats is True).
+        """
+        agent_copy = executor.get_agent(agent)
+        self.local.stats = SearchStats() if stats else None
+        try:
+            while True:
+                claimed = budget.claim(self.batch_size)
+                if claimed == 0:
+                    break
+                evaluated = 0
+                try:
+                    if self.max_nodes is None:
+                        evaluated = self._explore(self.root, agent_copy,
+                                                  claimed, verbose=verbose)
+                    else:
+                        evaluated = self._bounded_explore(agent_copy, claimed,
+                                                          verbose=verbose)
+                finally:
+                    budget.done(claimed, evaluated)
+            return self.local.stats
+        finally:
+            self.local.stats = None
+
+    def _bounded_explore(self, agent, size=None, verbose=False):
+        """ Explores the tree keeping it under max_nodes. The thread which
+        finds the tree over the cap waits for the rest of explorations to
+        finish (new ones wait meanwhile) and prunes it, so no thread is
+        inside the subtrees being collapsed. Returns the number of leaves
+        evaluated.
+        """
+        with self.explorations:
+            self.explorations.wait_for(lambda: not self.pruning)
+            self.active += 1
+        prune = False
+        try:
+            evaluated = self._explore(self.root, agent, size, verbose=verbose)
+        finally:
+            with self.explorations:
+                self.active -= 1
+                if self.num_nodes > self.max_nodes and not self.pruning:
+                    self.pruning = prune = True
+                self.explorations.notify_all()
+
+        if prune:
+            try:
+                with self.explorations:
+                    self.explorations.wait_for(lambda: self.active == 0)
+                self.prune()
+            finally:
+                with self.explorations:
+                    self.pruning = False
+                    self.explorations.notify_all()
+        return evaluated
+
+    def prune(self, max_nodes=None):
+        """ Collapses the least visited subtrees (see Node.collapse) until
+        the tree has at most PRUNE_RATIO * max_nodes nodes. The collapsed
+        nodes keep their stats, so the search goes on as if their subtree
+        was never explored below them. The root and its children are never
+        removed, so the tree can't go below them. It must not be called
+        while the tree is being searched by other threads.
+
+        Parameters:
+            max_nodes: int. Node cap (self.max_nodes if not given).
+        Returns:
+            removed: int. Number of nodes removed.
+        """
+        if max_nodes is None:
+            max_nodes = self.max_nodes
+        target = int(PRUNE_RATIO * max_nodes)
+
+        nodes = []
+        pending = [self.root]
+        while len(pending) > 0:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(node.children)
+        # Size of the subtree of each node
+        sizes = {}
+        for node in reversed(nodes):
+            sizes[node] = 1 + sum(sizes[c] for c in node.children)
+
+        total = sizes[self.root]
+        candidates = sorted((n for n in nodes
+                             if self._prunable(n) and len(n.children) > 0),
+                            key=lambda n: n.visits)
+        for node in candidates:
+            if total <= target:
+                break
+            if len(node.children) == 0:
+                continue
+            removed = sizes[node] - 1
+            node.collapse()
+            total -= removed
+            ancestor = node
+            while ancestor is not None:
+                sizes[ancestor] -= removed
+                ancestor = ancestor.parent
+
+        removed = len(nodes) - total
+        self.pruned += removed
+        self.num_nodes = total
+        return removed
+
+    def _prunable(self, node):
+        """ Whether prune() can collapse a node """
+        return node is not self.root
+
+    def _count_nodes(self):
+        count = 0
+        pending = [self.root]
+        while len(pending) > 0:
+            node = pending.pop()
+            count += 1
+            pending.extend(node.children)
+        return count
+
+    def footprint(self):
+        """ Returns the memory used by the tree: a dict with the number of
+        'nodes', how many of them keep their game ('states') and the
+        approx. 'bytes' of all of them.
+        """
+        nodes = states = nbytes = 0
+        pending = [self.root]
+        while len(pending) > 0:
+            node = pending.pop()
+            nodes += 1
+            states += node._state is not None
+            nbytes += node.nbytes
+            pending.extend(node.children)
+        return {'nodes': nodes, 'states': states, 'bytes': nbytes}
+
+    def reroot(self, game):
+        if not super().reroot(game):
+            return False
+        self.num_nodes = self._count_nodes()
+        return True
+
+    def _stats(self):
+        """ SearchStats of the calling thread (None if not collected) """
+        return self.local.stats
+
+    def _phase(self, name):
+        """ Context manager which measures a phase of the search (if the
+        thread collects stats).
+        """
+        stats = self.local.stats
+        if stats is None:
+            return NO_PHASE
+        return stats.phase(name)
+
+    def _locked(self, lock):
+        """ Context manager which holds a lock of the tree (measuring the
+        contention if the thread collects stats).
+        """
+        stats = self.local.stats
+        if stats is None:
+            return lock
+        return stats.locked(lock)
+
     def explore_tree(self, node, agent, verbose=False):
         agent_copy = agent.get_copy()
         agent_copy.connect()
+        self._explore(node, agent_copy, verbose=verbose)
+        agent_copy.disconnect()
 
+    def _explore(self, node, agent, size=None, verbose=False):
+        """ One iteration of the search (with up to size leaves, batch_size
+        by default) using a connected agent. Returns the number of leaves
+        evaluated.
+        """
+        if size is None:
+            size = self.batch_size
         start = timer()
-        current_node = self.select(node, agent_copy)
-        end = timer()
-        v = self.simulate(current_node, agent_copy)
-        self.backprop(current_node, v, remove_vloss=True)
+        if self.batch_size > 1:
+            leaves = self.select_batch(node, agent, size)
+            end = timer()
+            values = self.simulate_batch(leaves, agent)
+        else:
+            leaves = [self.select(node, agent)]
+            end = timer()
+            values = [self.simulate(leaves[0], agent)]
 
-        agent_copy.disconnect()
+        with self._phase('backprop'):
+            for leaf, v in zip(leaves, values):
+                self.backprop(leaf, v, remove_vloss=True)
+                self._release_state(leaf)
+
+        stats = self._stats()
+        if stats is not None:
+            for leaf in leaves:
+                stats.add_leaf(self._depth(leaf))
 
         elap = round(end - start, 2)
         if verbose:
             print(f"Elapsed on iteration: {elap} secs")
+        return len(leaves)
 
     def select(self, node, agent):
-        current_node = node
-        while not current_node.is_terminal_state:
-            if not current_node.is_fully_expanded:
-                current_node = self.expand(current_node, agent=agent)
-                break
-            else:
-                current_node = current_node.get_best_child()
+        """ Goes down the tree until a node which can be expanded. Only a
+        thread at a time expands a node (it claims it, see _claim), so its
+        priors and opponent replies are computed once. The other threads go
+        down through its current children or, if it has none yet, wait for
+        the expansion.
+        """
+        with self._phase('select'):
+            current_node = node
+            while not current_node.is_terminal_state:
+                if self._claim(current_node):
+                    try:
+                        child = self.expand(current_node, agent=agent)
+                    finally:
+                        self._release(current_node)
+                    current_node = child
+                    break
+                elif current_node.is_leaf and current_node.expanding:
+                    self._wait_expansion(current_node)
+                elif current_node.is_leaf:
+                    # Its expansion failed, it's evaluated again
+                    break
+                else:
+                    current_node = current_node.get_best_child()
 
-        # Wait if game is not updated yet
-        with current_node.lock:
-            current_node.vloss += VIRTUAL_LOSS
+            # Wait if game is not updated yet
+            with self._locked(current_node.lock):
+                current_node.vloss += VIRTUAL_LOSS
+                current_node.sync()
 
         return current_node
 
@@ -233,29 +1227,182 @@ class SelfPlayTree(Tree):
         From a given state (node), adds to itself all its children
         (game states after all the possible legal game moves are applied).
         Note that this process makes a move and assume that the game oponent
-        moves after our move, resulting in the new state.
+        moves after our move, resulting in the new state. The replies of the
+        opponent are computed in batches (see _opponent_replies): all of
+        them in the first expansion, or the next moves by prior with
+        progressive widening.
 
         Parameters:
             node: Node. Node which will be expanded.
         """
-        new_state = node.state.get_copy()
-        new_state.move(node.pop_unexpanded_action())
-        # Move oponent
-        if new_state.get_result() is None:
-            bm = agent.best_move(new_state, real_game=True)
-            new_state.move(bm)
+        with self._phase('expand'):
+            action, prior = self._pop_action(node, agent)
+            replies = node.replies
+            if replies is None or action not in replies:
+                # The remaining actions are in expansion order (the last
+                # one goes first)
+                pending = node.unexpanded_actions
+                if self.widening is not None:
+                    pending = pending[-len(node.children):] \
+                        if len(node.children) > 0 else []
+                replies = self._opponent_replies(node, agent,
+                                                 [action] + pending)
+            move = chess.Move.from_uci(action)
+            new_state = node.get_state_copy()
+            new_state.push(move)
+            # Move oponent
+            reply = replies[action]
+            if reply is not None:
+                new_state.push(reply)
+            return self._add_child(node, new_state, move, reply, agent,
+                                   prior)
+
+    def _claim(self, node):
+        """ Claims the expansion of a node if it can be expanded and no
+        other thread is doing it. Returns whether it was claimed.
+        """
+        # Checked without the lock first, so the nodes being expanded by
+        # other threads aren't waited for
+        if not self._can_expand(node) or node.expanding:
+            return False
+        with self._locked(node.lock):
+            if node.expanding or not self._can_expand(node):
+                return False
+            node.expanding = True
+        return True
 
-        new_child = Node(new_state, parent=node)
-        node.children.append(new_child)
+    def _release(self, node):
+        """ Releases the claim of a node, waking up the waiting threads. """
+        node.expanding = False
+        if self.expansion_waiters > 0:
+            with self.expansions:
+                self.expansions.notify_all()
+
+    def _wait_expansion(self, node):
+        """ Waits for the expansion of a node (with no children yet) by
+        another thread.
+        """
+        stats = self._stats()
+        start = timer() if stats is not None else 0
+        with self.expansions:
+            self.expansion_waiters += 1
+            try:
+                self.expansions.wait_for(lambda: not node.expanding)
+            finally:
+                self.expansion_waiters -= 1
+        if stats is not None:
+            stats.add_node_wait(timer() - start)
+
+    def _can_expand(self, node):
+        """ Whether the selection creates a new child of a node instead of
+        going down to one of its children. With progressive widening, only
+        ceil(widening * visits^widening_exp) children are allowed.
+        """
+        if node.is_fully_expanded:
+            return False
+        if self.widening is None:
+            return True
+        allowed = math.ceil(self.widening * node.visits ** self.widening_exp)
+        return len(node.children) < max(allowed, 1)
+
+    def _pop_action(self, node, agent):
+        """ Takes the next legal move of a node to expand. With progressive
+        widening, the moves are sorted by prior in the first expansion (the
+        node is evaluated then if it has no policy) and taken in descending
+        order.
+
+        Parameters:
+            node: Node. Node being expanded.
+            agent: Agent. Used if the node has no policy.
+        Returns:
+            action: str. UCI of the move.
+            prior: float. Prior of the move (None without widening, the
+            priors are set when all the children have been created).
+        """
+        if self.widening is None:
+            return node.pop_unexpanded_action(), None
+
+        if not node.priors_set:
+            priors = node.policy
+            if priors is None:
+                priors = self._predict_priors(node, agent)
+            self._set_priors(node, priors)
+        with node.lock:
+            return node._unexpanded_actions.pop(), node.action_priors.pop()
+
+    def _add_child(self, node, state, move, reply, agent, prior=None):
+        """ Creates the child of a node for the given move and reply. If
+        it's the last child of the node, the priors of all of them are set
+        (unless the prior of each one is given).
+
+        Parameters:
+            node: Node. Node being expanded.
+            state: Game. Game of the new child (it keeps it until it's
+            evaluated).
+            move, reply: chess.Move. Moves of the edge.
+            agent: Agent. Used if the node has no policy.
+            prior: float. Prior of the child.
+        Returns:
+            child: Node. New child.
+        """
+        new_child = Node(parent=node, move=move, reply=reply,
+                         result=state.get_result())
+        if prior is not None:
+            new_child.prior = prior
+        # Kept until the child is evaluated
+        new_child.keep_state(state)
+        node.add_child(new_child)
+        self.num_nodes += 1
 
         # If this node was the last one before fully expand the node
         # we calculate the priors of the children
         # (only do it once)
         if node.is_fully_expanded:
-            self._update_prior(node, agent)
+            node.replies = None
+            if self.widening is None:
+                self._update_prior(node, agent)
+            stats = self._stats()
+            if stats is not None:
+                stats.add_expansion(node.num_actions)
 
         return new_child
 
+    def _opponent_replies(self, node, agent, actions):
+        """ Computes the move the opponent makes (the one with the highest
+        prior, as agent.best_move(real_game=True)) after some legal moves of
+        a node. All the games are evaluated in a single request and the
+        replies are kept in the node for the rest of its expansion.
+
+        Parameters:
+            node: Node. Node being expanded.
+            agent: Agent. Used to predict the priors of the opponent.
+            actions: list[str]. Moves (UCI) of the node.
+        Returns:
+            replies: dict. 'uci' -> reply (None if the game ends with
+            the move).
+        """
+        state = node.state
+        replies = {}
+        games = []
+        for action in actions:
+            game = state.get_copy()
+            game.push(chess.Move.from_uci(action))
+            replies[action] = None
+            if game.get_result() is None:
+                games.append((action, game))
+
+        if len(games) > 0:
+            with self._phase('opponent_move'):
+                evaluations = agent.evaluate_batch([g for _, g in games])
+            for (action, game), (priors, _) in zip(games, evaluations):
+                replies[action] = list(game.board.legal_moves)[
+                    np.argmax(priors)]
+        with node.lock:
+            if node.replies is not None:
+                replies.update(node.replies)
+            node.replies = replies
+        return replies
+
     def simulate(self, node: Node, agent: Player):
         """ Rollout from the current node until a final state.
 
@@ -265,9 +1412,19 @@ class SelfPlayTree(Tree):
         Returns:
             results_sim: float, Result of the playout/predicted value from NN.
         """
-        result = node.state.get_result()
+        result = node.result
         if result is None:
-            result = agent.predict_outcome(node.state)
+            result = self._take_predicted_value(node)
+        if result is None and self.transpositions is not None:
+            (policy, result), = self._evaluate([node.state], agent,
+                                               keys=[node])
+            self._keep_policy(node, policy)
+        elif result is None:
+            # The priors are kept for the expansion of the node
+            state = node.state
+            with self._phase('eval_wait'):
+                policy, result = agent.evaluate(state)
+            self._keep_policy(node, policy)
 
             # Random sim
             # sim = RandomSimulation(node.state.get_copy())
@@ -275,6 +1432,104 @@ class SelfPlayTree(Tree):
 
         return result
 
+    def select_batch(self, node, agent, size):
+        """ Selects several leaves to be evaluated at once. The virtual loss
+        of the first ones makes the next selections to go through other paths.
+
+        Parameters:
+            node: Node. Node from which the selection starts.
+            agent: Agent. Used in the expansions.
+            size: int. Max. number of leaves to select.
+        Returns:
+            leaves: list[Node]. Selected leaves.
+        """
+        return [self.select(node, agent) for _ in range(size)]
+
+    def simulate_batch(self, leaves, agent: Player):
+        """ Evaluates several leaves making a single request to the neural
+        net. The policies are stored in the nodes to compute the priors of
+        their children later.
+
+        Parameters:
+            leaves: list[Node]. Nodes to evaluate.
+            agent: Agent. that will be used to make the prediction.
+        Returns:
+            values: list[float]. Result/predicted value of each leaf.
+        """
+        values = [n.result if n.result is not None else
+                  self._take_predicted_value(n) for n in leaves]
+        pending = [leaves[i] for i, v in enumerate(values) if v is None]
+        if len(pending) > 0:
+            evaluations = iter(self._evaluate([n.state for n in pending],
+                                              agent, keys=pending))
+            for i, v in enumerate(values):
+                if v is None:
+                    policy, values[i] = next(evaluations)
+                    self._keep_policy(leaves[i], policy)
+        return values
+
+    def _take_predicted_value(self, node):
+        """ Returns the value of a node predicted when it was expanded before
+        its evaluation (see _predict_priors), None if there isn't.
+        """
+        with node.lock:
+            value, node.predicted_value = node.predicted_value, None
+        return value
+
+    def _evaluate(self, states, agent, keys):
+        """ Gets the priors (over the legal moves) and values of several
+        games. The ones in the transposition table are taken from it and the
+        rest are predicted with a single request (and added to the table).
+
+        Parameters:
+            states: list[Game]. Games (not finished) to evaluate.
+            agent: Agent. Used to make the predictions.
+            keys: list. Nodes of the states. Their key attribute is set with
+            the position key if the tree uses a transposition table.
+        Returns:
+            evaluations: list[(priors, value)].
+        """
+        evaluations = [None] * len(states)
+        pending = list(range(len(states)))
+        if self.transpositions is not None:
+            pending = []
+            for i, state in enumerate(states):
+                key = position_key(state.board)
+                self._set_key(keys[i], key)
+                entry = self.transpositions.lookup(key)
+                if entry is None:
+                    pending.append(i)
+                else:
+                    evaluations[i] = (entry.priors, entry.get_value())
+
+        predictions = []
+        with self._phase('eval_wait'):
+            if len(pending) == 1:
+                predictions = [agent.evaluate(states[pending[0]])]
+            elif len(pending) > 1:
+                predictions = agent.evaluate_batch([states[i]
+                                                    for i in pending])
+        for i, (priors, value) in zip(pending, predictions):
+            evaluations[i] = (priors, value)
+            if self.transpositions is not None:
+                self.transpositions.store(position_key(states[i].board),
+                                          priors, value)
+        return evaluations
+
+    def _set_key(self, node, key):
+        node.key = key
+
+    def _release_state(self, node):
+        node.release_state()
+
+    def _depth(self, node):
+        """ Number of edges between the root and a node """
+        depth = 0
+        while node is not self.root and node.parent is not None:
+            node = node.parent
+            depth += 1
+        return depth
+
     def backprop(self, node: Node, value: float, remove_vloss=False):
         """ Backpropagation phase of the algorithm.
 
@@ -286,37 +1541,580 @@ class SelfPlayTree(Tree):
             remove_vloss: Remove virtual loss from the parent nodes to allow
                 the exploration of the same path by other threads
         """
-        with node.lock:
+        with self._locked(node.lock):
             node.visits += 1
             node.value += value
             if remove_vloss:
                 node.vloss -= VIRTUAL_LOSS
+            node.sync()
+
+        if node.key is not None:
+            self.transpositions.update(node.key, value)
 
         if node.parent is not None:
+            with self._locked(node.parent.lock):
+                node.parent.children_visits += 1
             self.backprop(node.parent, value)
 
     def _update_prior(self, node, agent):
-        """ Update the priors of the children nodes """
-        priors = agent.predict_policy(node.state, mask_legal_moves=True)
-        children = reversed(node.children)
-        for p, n in zip(priors, children):
-            n.prior = p
+        """ Update the priors of the children nodes (once all of them have
+        been created) with the policy of the node. If it has none because
+        its evaluation hasn't arrived yet, they're set then (see
+        _keep_policy) instead of predicting it again.
+        """
+        with node.lock:
+            priors = node.policy
+            if priors is None and self._evaluation_pending(node):
+                return
+        if priors is None:
+            priors = self._predict_priors(node, agent)
+        self._set_priors(node, priors)
 
-    def compute_policy(self, node: Node, noise=True):
+    def _predict_priors(self, node, agent):
+        """ Predicts the policy of a node to set the priors of its children.
+        If the node is still waiting for its evaluation, the predicted value
+        is kept for it (see simulate), so it isn't predicted twice.
+        """
+        if not self._evaluation_pending(node):
+            # The root (or a node whose policy was dropped)
+            state = node.state
+            with self._phase('eval_wait'):
+                priors, _ = agent.evaluate(state)
+            return priors
+        (priors, value), = self._evaluate([node.state], agent, keys=[node])
+        with node.lock:
+            if self._evaluation_pending(node) and node.policy is None:
+                node.predicted_value = value
+        return priors
+
+    def _set_priors(self, node, priors):
+        """ Sets the priors of the children of a node from its policy (over
+        the legal moves) and drops the policy. It's done once per node.
+        Without widening, all the children have been created and get their
+        prior. With widening, it's done before the first child is created:
+        the legal moves are sorted by prior to be expanded in that order
+        and each child gets its prior when it's created.
+
+        Parameters:
+            node: Node. Node being expanded.
+            priors: list. Priors of the legal moves of the node.
+        """
+        with node.lock:
+            if node.priors_set:
+                return
+            if node is self.root:
+                priors = self._root_priors(priors)
+            if self.widening is None:
+                children = reversed(node.children)
+                for p, n in zip(priors, children):
+                    n.prior = p
+                    n.sync()
+            else:
+                actions = node.unexpanded_actions
+                order = np.argsort(priors, kind='stable')
+                node._unexpanded_actions = [actions[i] for i in order]
+                node.action_priors = [priors[i] for i in order]
+            node.priors_set = True
+            node.policy = None
+
+    def _keep_policy(self, node, policy):
+        with node.lock:
+            # Its evaluation arrived, a value predicted meanwhile isn't used
+            node.predicted_value = None
+            super()._keep_policy(node, policy)
+
+    def _root_priors(self, priors):
+        """ Mixes the priors of the root children with Dirichlet noise """
+        if self.root_noise > 0:
+            priors = (1 - self.root_noise) * np.asarray(priors) +\
+                self.root_noise * np.random.dirichlet([0.03] * len(priors))
+        return priors
+
+
+class PlySelfPlayTree(SelfPlayTree):
+    """ SelfPlayTree with a node per ply. The opponent moves aren't chosen
+    with an extra prediction when a node is expanded, they're children of
+    our moves and are searched like them. The priors of each node come from
+    the evaluation of its parent (the policy of the side to move there), so
+    a single prediction serves both sides.
+
+    The values of the nodes are from the point of view of the player who
+    made their move, so the sign of the backpropagated value flips at each
+    ply and each side picks the best children for itself.
+
+    Parameters:
+        See SelfPlayTree.
+    """
+    def expand(self, node, agent=None):
+        """ Adds the child of one of the legal moves of the node (a single
+        ply). When all the children have been added, their priors are set.
+
+        Parameters:
+            node: Node. Node which will be expanded.
+        """
+        with self._phase('expand'):
+            action, prior = self._pop_action(node, agent)
+            move = chess.Move.from_uci(action)
+            new_state = node.get_state_copy()
+            new_state.push(move)
+            return self._add_child(node, new_state, move, None, agent,
+                                   prior)
+
+    def backprop(self, node: Node, value: float, remove_vloss=False):
+        """ Backpropagation phase of the algorithm. Each node gets the
+        value for the player who made its move.
+
+        Parameters:
+            node: Node. Evaluated leaf.
+            value: float. Result/predicted value of the leaf for the white
+            pieces.
+            remove_vloss: Remove the virtual loss of the leaf.
+        """
+        sign = self._mover_sign(node)
+        while node is not None:
+            with self._locked(node.lock):
+                node.visits += 1
+                node.value += sign * value
+                if remove_vloss:
+                    node.vloss -= VIRTUAL_LOSS
+                node.sync()
+
+            # The transposition table keeps the values for the whites
+            if node.key is not None:
+                self.transpositions.update(node.key, value)
+
+            if node.parent is not None:
+                with self._locked(node.parent.lock):
+                    node.parent.children_visits += 1
+            node = node.parent
+            sign = -sign
+            remove_vloss = False
+
+    def _mover_sign(self, node):
+        """ Returns 1 if the move of a node is made by the whites, -1 if
+        it's made by the blacks.
+        """
+        # The odd plies are moves of the side to move at the root
+        white = self.root.state.turn == (self._depth(node) % 2 == 1)
+        return 1 if white else -1
+
+    def _prunable(self, node):
+        # The children of the root give the reply of get_child_moves, so
+        # they're only collapsed if they keep the priors of their moves
+        if node is self.root:
+            return False
+        return node.parent is not self.root or \
+            node.action_priors is not None or node.is_fully_expanded
+
+    def get_child_moves(self, index):
+        """ Returns the moves (UCI) of one of the root children and the
+        reply the search expects from the opponent: the most visited child
+        of it (the move with the highest prior if it has none yet).
+
+        Parameters:
+            index: int. Position of the child in the root children.
+        """
+        child = self.root.children[index]
+        reply = Game.NULL_MOVE
+        if not child.is_terminal_state:
+            if len(child.children) > 0:
+                best = max(child.children, key=lambda c: c.visits)
+                reply = best.move.uci()
+            else:
+                reply = child.state.get_legal_moves()[
+                    np.argmax(child.policy)]
+        return child.move.uci(), reply
+
+
+class CompactSelfPlayTree(SelfPlayTree):
+    """ SelfPlayTree which keeps its nodes in a NodeStore (arrays) instead of
+    Node objects. Nodes only hold the moves that lead to them, the games are
+    rebuilt from the root one when they are needed. The children of a node
+    are created all at once when it's evaluated, using the policy of the same
+    prediction as priors.
+
+    Parameters:
+        root: Game. Root state of the tree.
+        threads: int. Number of threads used in the search.
+        batch_size, transpositions, root_noise, executor: See SelfPlayTree.
+    """
+    ROOT = 0
+
+    def __init__(self, root, threads=6, batch_size=1, transpositions=None,
+                 root_noise=0, executor=None):
+        self.executor = executor
+        self.game = netencoder.track_history(root.get_copy())
+        self.store = NodeStore()
+        self.store.allocate(1)
+        self.store.reply[self.ROOT] = nodestore.NO_MOVE
+        self.store.visits[self.ROOT] = 1
+        self.root = self.ROOT
+        self.num_threads = threads
+        self.batch_size = batch_size
+        self.transpositions = transpositions
+        self.root_noise = root_noise
+        self.transposition_hits = 0
+        self.search_info = None
+        self.local = SearchLocal()
+        self.max_nodes = None
+
+    @property
+    def root_visits(self):
+        return int(self.store.visits[self.ROOT])
+
+    @property
+    def num_nodes(self):
+        return len(self.store)
+
+    def root_children_visits(self):
+        return self.store.visits[self.store.children(self.ROOT)]
+
+    def reroot(self, game):
+        """ Moves the root of the tree to the descendant matching the game.
+        The subtree of the new root is copied to a new store, so the memory
+        of the rest of the tree is released.
+        """
+        store = self.store
+        root_moves = self.game.board.move_stack
+        played = game.board.move_stack[len(root_moves):]
+        if game.board.move_stack[:len(root_moves)] != root_moves:
+            return False
+
+        current = self.ROOT
+        while len(played) > 0:
+            children = store.children(current)
+            for c in range(children.start, children.stop):
+                reply = store.reply[c]
+                if reply == nodestore.UNRESOLVED or \
+                        reply == nodestore.RESOLVING:
+                    continue
+                edge = [nodestore.decode_move(store.move[c])]
+                if reply != nodestore.NO_MOVE:
+                    edge.append(nodestore.decode_move(reply))
+                if played[:len(edge)] == edge:
+                    current = c
+                    played = played[len(edge):]
+                    break
+            else:
+                return False
+
+        self.store = store.subtree(current)
+        self.store.move[self.ROOT] = nodestore.NO_MOVE
+        self.store.reply[self.ROOT] = nodestore.NO_MOVE
+        self.store.visits[self.ROOT] = max(self.store.visits[self.ROOT], 1)
+        self.game = netencoder.track_history(game.get_copy())
+        return True
+
+    def get_state(self, index):
+        """ Rebuilds the game of a node applying the moves of its ancestors
+        to the root game.
+
+        Parameters:
+            index: int. Node of the store.
+        Returns:
+            state: Game. Copy of the game at the node.
+        """
+        store = self.store
+        moves = []
+        while index != self.ROOT:
+            moves.append((store.move[index], store.reply[index]))
+            index = store.parent[index]
+
+        state = self.game.get_copy()
+        for m, r in reversed(moves):
+            state.push(nodestore.decode_move(m))
+            if r >= 0:
+                state.push(nodestore.decode_move(r))
+        return state
+
+    def select(self, node, agent, wait=True, collisions=None):
+        """ Selects the leaf to evaluate. Nodes being expanded by other threads
+        are waited for unless wait is False. In that case, None is returned
+        (collision) instead of a leaf and the virtual loss of the node is
+        increased (so the next selections avoid it). The node is appended to
+        collisions.
+        """
+        with self._phase('select'):
+            return self._select(node, agent, wait, collisions)
+
+    def _select(self, node, agent, wait, collisions):
+        store = self.store
+        stats = self._stats()
+        current = node
+        self._acquire(store.lock)
+        try:
+            while store.result[current] == nodestore.NOT_OVER:
+                first = store.first_child[current]
+                if first == nodestore.NO_NODE:
+                    # Unexpanded node. We claim it, it will be expanded when
+                    # it's evaluated.
+                    store.first_child[current] = nodestore.EXPANDING
+                    break
+                elif first == nodestore.EXPANDING:
+                    if not wait:
+                        store.vloss[current] += VIRTUAL_LOSS
+                        collisions.append(current)
+                        return None
+                    start = timer() if stats is not None else 0
+                    store.lock.wait_for(
+                        lambda: store.first_child[current] !=
+                        nodestore.EXPANDING)
+                    if stats is not None:
+                        stats.add_node_wait(timer() - start)
+                    continue
+
+                current = self._best_child(current)
+                reply = store.reply[current]
+                if reply == nodestore.UNRESOLVED:
+                    store.reply[current] = nodestore.RESOLVING
+                    store.lock.release()
+                    reply, result = nodestore.UNRESOLVED, nodestore.NOT_OVER
+                    try:
+                        reply, result = self._opponent_move(current, agent)
+                    finally:
+                        self._acquire(store.lock)
+                        store.reply[current] = reply
+                        store.result[current] = result
+                        store.lock.notify_all()
+                elif reply == nodestore.RESOLVING:
+                    if not wait:
+                        store.vloss[current] += VIRTUAL_LOSS
+                        collisions.append(current)
+                        return None
+                    start = timer() if stats is not None else 0
+                    store.lock.wait_for(
+                        lambda: store.reply[current] != nodestore.RESOLVING)
+                    if stats is not None:
+                        stats.add_node_wait(timer() - start)
+
+            store.vloss[current] += VIRTUAL_LOSS
+        finally:
+            store.lock.release()
+
+        return current
+
+    def _acquire(self, lock):
+        """ Acquires a lock (see SelfPlayTree._locked) """
+        stats = self._stats()
+        if stats is None:
+            lock.acquire()
+        else:
+            stats.acquire(lock)
+
+    def _best_child(self, index):
+        """ Returns the child of a node which will be explored. The children
+        which have not been visited yet (nor are being resolved/visited by
+        other threads) go first. Then, the one with max. PUCT value. Must be called
+        holding the store lock.
+        """
+        store = self.store
+        children = store.children(index)
+        visits = store.visits[children]
+        vloss = store.vloss[children]
+
+        fresh = np.flatnonzero((visits == 0) & (vloss == 0) &
+                               (store.reply[children] == nodestore.UNRESOLVED))
+        if len(fresh) > 0:
+            best = fresh[0]
+        else:
+            values = store.value[children] / (1 + visits) +\
+                PUCT_C * store.prior[children] *\
+                np.sqrt(store.child_visits[children]) / (1 + visits)
+            best = np.argmax(values - vloss)
+        return children.start + best
+
+    def _opponent_move(self, index, agent):
+        """ Computes the move the opponent makes after the move of a node.
+
+        Returns:
+            reply: int. Encoded move of the opponent (NO_MOVE if the game
+            finished after our move).
+            result: int. Result of the game after the reply.
+        """
+        state = self.get_state(self.store.parent[index])
+        state.push(nodestore.decode_move(self.store.move[index]))
+        reply = nodestore.NO_MOVE
+        if state.get_result() is None:
+            with self._phase('opponent_move'):
+                bm = chess.Move.from_uci(agent.best_move(state,
+                                                         real_game=True))
+            state.push(bm)
+            reply = nodestore.encode_move(bm)
+
+        result = state.get_result()
+        if result is None:
+            result = nodestore.NOT_OVER
+        return reply, result
+
+    def expand(self, node, agent=None, priors=None, state=None):
+        """ Creates all the children of a node (one for each legal move) in a
+        contiguous block of the store.
+
+        Parameters:
+            node: int. Node which will be expanded.
+            priors: list. Prior probabilities of the legal moves.
+            state: Game. Game at the node (it's rebuilt if not given).
+        """
+        with self._phase('expand'):
+            if state is None:
+                state = self.get_state(node)
+            legal_moves = list(state.board.legal_moves)
+            if node == self.ROOT:
+                priors = self._root_priors(priors)
+
+            store = self.store
+            with self._locked(store.lock):
+                first = store.allocate(len(legal_moves), parent=node)
+                children = store.children(node)
+                store.move[children] = [nodestore.encode_move(m)
+                                        for m in legal_moves]
+                store.prior[children] = priors
+                store.lock.notify_all()
+
+        stats = self._stats()
+        if stats is not None:
+            stats.add_expansion(len(legal_moves))
+        return first
+
+    def simulate(self, node, agent: Player):
+        """ Evaluates a node with the neural net and expands it.
+
+        Parameters:
+            node: int. Node of the store.
+            agent: Agent. that will be used to play the games.
+        Returns:
+            results_sim: float, Result of the game/predicted value from NN.
+        """
+        result = self.store.result[node]
+        if result != nodestore.NOT_OVER:
+            return float(result)
+
+        try:
+            state = self.get_state(node)
+            (priors, value), = self._evaluate([state], agent, keys=[node])
+            self.expand(node, agent, priors=priors, state=state)
+        except Exception:
+            self._release_claims([node])
+            raise
+        return value
+
+    def select_batch(self, node, agent, size):
+        """ Makes up to size selections. The ones reaching a node claimed by
+        other batch (this one or from other thread) are discarded, so some
+        leaves may be returned. Only the first selection waits, when we
+        don't hold any claim yet.
+        """
+        leaves, collisions = [], []
+        for _ in range(size):
+            leaf = self.select(node, agent, wait=len(leaves) == 0,
+                               collisions=collisions)
+            if leaf is not None:
+                leaves.append(leaf)
+
+        with self.store.lock:
+            for n in collisions:
+                self.store.vloss[n] -= VIRTUAL_LOSS
+        return leaves
+
+    def simulate_batch(self, leaves, agent: Player):
+        """ Evaluates and expands several leaves making a single request to
+        the neural net.
+        """
+        store = self.store
+        values = [float(store.result[n]) for n in leaves]
+        pending = [i for i, n in enumerate(leaves)
+                   if store.result[n] == nodestore.NOT_OVER]
+        if len(pending) == 0:
+            return values
+
+        try:
+            states = [self.get_state(leaves[i]) for i in pending]
+            evaluations = self._evaluate(states, agent,
+                                         keys=[leaves[i] for i in pending])
+            for i, state, (priors, value) in zip(pending, states, evaluations):
+                self.expand(leaves[i], agent, priors=priors, state=state)
+                values[i] = value
+        except Exception:
+            self._release_claims([leaves[i] for i in pending])
+            raise
+        return values
+
+    def _release_claims(self, nodes):
+        """ Releases the expansion claims of some nodes (if they weren't
+        expanded) so other threads don't wait forever for them.
+        """
+        with self.store.lock:
+            for n in nodes:
+                if self.store.first_child[n] == nodestore.EXPANDING:
+                    self.store.first_child[n] = nodestore.NO_NODE
+            self.store.lock.notify_all()
+
+    def backprop(self, node, value: float, remove_vloss=False):
+        store = self.store
+        keys = []
+        with self._locked(store.lock):
+            if remove_vloss:
+                store.vloss[node] -= VIRTUAL_LOSS
+            store.visits[node] += 1
+            store.value[node] += value
+            keys.append(store.key[node])
+            parent = store.parent[node]
+            while parent != nodestore.NO_NODE:
+                store.visits[parent] += 1
+                store.value[parent] += value
+                store.child_visits[parent] += 1
+                keys.append(store.key[parent])
+                parent = store.parent[parent]
+
+        if self.transpositions is not None:
+            for key in keys:
+                if key != nodestore.NO_KEY:
+                    self.transpositions.update(int(key), value)
+
+    def _set_key(self, node, key):
+        self.store.key[node] = key
+
+    def _release_state(self, node):
+        # The nodes of the store never keep a game
+        pass
+
+    def footprint(self):
+        """ See SelfPlayTree.footprint. Only the root keeps a game. """
+        return {'nodes': len(self.store), 'states': 1,
+                'bytes': self.store.nbytes + _game_bytes(self.game)}
+
+    def _depth(self, node):
+        depth = 0
+        while node != self.ROOT:
+            node = self.store.parent[node]
+            depth += 1
+        return depth
+
+    def compute_policy(self, node, noise=True):
         """ Calculates the policy vector given a game state """
-        # Select tau = 1 -> 0 (if number of moves > 30)
-        nb_moves = len(node.state.board.move_stack)
+        nb_moves = len(self.game.board.move_stack)
         tau = 1
         if nb_moves >= 30:
             tau = nb_moves / (1 + np.power(nb_moves, 1.3))
 
-        # Select argmax π(a|node) proportional to the visit count
-        policy = np.array([np.power(v.visits, 1 / tau) for v in node.children])\
-            / np.power(node.visits, 1 / tau)
+        store = self.store
+        children = store.children(node)
+        policy = np.power(store.visits[children], 1 / tau) /\
+            np.power(store.visits[node], 1 / tau)
 
-        # apply random noise for ensuring exploration
+        # Unlike SelfPlayTree, not all the children have been visited. Noise
+        # is only added to the visited ones (the others have no reply yet).
         if noise:
             epsilon = 0.25
-            policy = (1 - epsilon) * policy +\
-                np.random.dirichlet([0.03] * len(node.children))
+            visited = store.visits[children] > 0
+            policy = (1 - epsilon) * policy
+            policy[visited] += np.random.dirichlet([0.03] * visited.sum())
         return policy
+
+    def get_child_moves(self, index):
+        child = self.store.children(self.ROOT).start + index
+        moves = []
+        for code in (self.store.move[child], self.store.reply[child]):
+            move = nodestore.decode_move(code)
+            moves.append(move.uci() if move else Game.NULL_MOVE)
+        return tuple(moves)
@@ -71,15 +71,21 @@ def _get_game_history(board, T=8):
 
 def get_game_state(game, flipped=False):
     """ This method returns the matrix representation of a game with its
-    history of moves.
+    history of moves. If the game keeps its EncodedHistory, it's taken from
+    there.
 
     Parameters:
         game: Game. Game state.
+        flipped: bool. Whether to rotate the board 180 degrees.
     Returns:
         current: numpy array. 3D Matrix with dimensions 8x8x[14(T+1)]. Where T
         corresponds to the number of backward turns in time.
     """
 
+    history = getattr(game, 'encoded_history', None)
+    if history is not None and history.matches(game.board):
+        return history.get_game_state(game.turn, flipped)
+
     board = game.board
     current = _get_current_game_state(board)
     history = _get_game_history(board)
@@ -91,6 +97,360 @@ def get_game_state(game, flipped=False):
     return current
 
 
+def get_board_bitboards(board):
+    """ Returns the bitboards (64-bit masks of the squares, a1 is the lowest
+    bit) of the pieces of a board.
+
+    Parameters:
+        board: Python-Chess board.
+    Returns:
+        bitboards: np.array. uint64 array of shape (2, 6): [color (black,
+        white), piece type - 1].
+    """
+    return np.array(_board_masks(board), dtype=np.uint64)
+
+
+def _board_masks(board):
+    """ Returns the bitboards of get_board_bitboards() as lists of ints. """
+    pieces = (board.pawns, board.knights, board.bishops, board.rooks,
+              board.queens, board.kings)
+    return [[p & board.occupied_co[color] for p in pieces]
+            for color in (chess.BLACK, chess.WHITE)]
+
+
+def bitboards_to_planes(bitboards):
+    """ Expands bitboards into the planes of _get_current_game_state, all of
+    them at once with np.unpackbits.
+
+    Parameters:
+        bitboards: np.array. uint64 array of shape (..., 2, 6) (see
+        get_board_bitboards).
+    Returns:
+        planes: np.array. uint8 array of shape (..., 8, 8, 14): for each
+        color (black first), the empty squares (of that color) and its 6
+        piece types.
+    """
+    lead = bitboards.shape[:-2]
+    # Each bitboard as 8 bytes (one per rank, little endian) and each byte
+    # as 8 bits (one per file)
+    data = np.ascontiguousarray(bitboards, dtype='<u8').view(np.uint8)
+    bits = np.unpackbits(data.reshape(lead + (2, 6, 8, 1)), axis=-1,
+                         bitorder='little')
+    return _piece_planes(np.moveaxis(bits, (-4, -3), (-2, -1)))
+
+
+def _piece_planes(bits):
+    """ Builds the planes of bitboards_to_planes() from the pieces of each
+    square, an array of shape (..., rank (the 1st first), file, color,
+    piece type).
+    """
+    lead = bits.shape[:-4]
+    planes = np.empty(lead + (8, 8, 2, 7), dtype=np.uint8)
+    # The 8th rank on top
+    bits = bits[..., ::-1, :, :, :]
+    planes[..., 1:] = bits
+    planes[..., 0] = 1 - bits.max(axis=-1)
+    return planes.reshape(lead + (8, 8, 14))
+
+
+def _states_array(n, T, out=None, dtype=np.float32):
+    """ Returns the array for the inputs of n positions: a new one, or the
+    first n rows of out (after checking its shape).
+    """
+    shape = (n, 8, 8, 14 * (T + 1) + 1)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if out.shape[1:] != shape[1:] or len(out) < n:
+        raise ValueError(f"Array of shape {out.shape} can't hold the "
+                         f"states of shape {shape}")
+    return out[:n]
+
+
+def _write_states(planes, num_steps, turns, out, flipped=False):
+    """ Writes the inputs of the network of several positions.
+
+    Parameters:
+        planes: np.array. uint8 array of shape (N, T+1, 8, 8, 14) with the
+        planes of each position of the history (see bitboards_to_planes).
+        num_steps: np.array. Positions of the history of each input (the
+        rest of the planes are set to zeros).
+        turns: list[bool]. Turn of each position.
+        out: np.array. Array of shape (N, 8, 8, 14(T+1)+1) where they're
+        written.
+        flipped: bool or list[bool]. Whether to rotate each board 180
+        degrees.
+    """
+    n, steps = planes.shape[:2]
+    # The steps without history are zeros (not empty boards)
+    planes[np.arange(steps) >= np.asarray(num_steps)[:, None]] = 0
+    flipped = np.broadcast_to(flipped, n)
+    if flipped.any():
+        planes[flipped] = planes[flipped][:, :, ::-1, ::-1]
+
+    # View of the planes of out as (N, rank, file, step, plane), so they're
+    # written without intermediate arrays
+    history = out[..., :-1]
+    history.shape = (n, 8, 8, steps, 14)
+    history[...] = np.moveaxis(planes, 1, 3)
+    out[..., -1] = np.asarray(turns)[:, None, None]
+
+
+def _fill_states(histories, turns, out, flipped=False):
+    """ Writes the inputs of the network of the EncodedHistory of several
+    positions (see _write_states).
+    """
+    planes = bitboards_to_planes(np.stack([h.bitboards for h in histories]))
+    _write_states(planes, [h.num_steps for h in histories], turns, out,
+                  flipped)
+
+
+def _game_histories(games, T=8):
+    """ Returns the EncodedHistory of each game (the one it keeps, if it's
+    up to date).
+    """
+    histories = []
+    for game in games:
+        history = getattr(game, 'encoded_history', None)
+        if history is None or history.T != T or \
+                not history.matches(game.board):
+            history = EncodedHistory.from_board(game.board, T)
+        histories.append(history)
+    return histories
+
+
+def get_game_states(games, out=None, dtype=np.float32, flipped=False, T=8):
+    """ Returns the input of the network (as get_game_state()) of several
+    games, written in a single array. The EncodedHistory of the games is
+    used when they keep one.
+
+    Parameters:
+        games: list[Game]. Games to encode.
+        out: np.array. Array of shape (M, 8, 8, 14(T+1)+1) (M >= N) where
+        the inputs are written. If None, a new one is made.
+        dtype: np.dtype. Type of the new array.
+        flipped: bool or list[bool]. Whether to rotate each board 180
+        degrees.
+        T: int. Number of backward turns of the history.
+    Returns:
+        states: np.array. Inputs of the games, (N, 8, 8, 14(T+1)+1). A view
+        of out if it's given.
+    """
+    out = _states_array(len(games), T, out, dtype)
+    if len(games) > 0:
+        _fill_states(_game_histories(games, T), [g.turn for g in games], out,
+                     flipped)
+    return out
+
+
+def get_game_state_bitboards(game, flipped=False, T=8):
+    """ Same as get_game_state() (the result is identical), but it
+    reads the bitboards of the positions and expands all of them at once
+    instead of building each plane from lists of squares.
+
+    Parameters:
+        game: Game. Game state.
+        flipped: bool. Whether to rotate the board 180 degrees.
+        T: int. Number of backward turns of the history.
+    Returns:
+        current: numpy array. 3D Matrix with dimensions 8x8x[14(T+1)+1].
+    """
+    return EncodedHistory.from_board(game.board, T).get_game_state(
+        game.turn, flipped)
+
+
+class EncodedHistory(object):
+    """ Rolling window with the encoded positions of the last T moves of a
+    game (and the current one), kept as their bitboards. Pushing a move
+    encodes only the new position, so the input of the network of a game
+    doesn't need to encode again the positions seen by its parent. It's not
+    modified after its creation (push() returns a new one), so the copies of
+    a game can share it.
+
+    Games carry it in Game.encoded_history (see track_history()) and keep it
+    up to date when their moves are made with Game.push() or Game.move().
+
+    Parameters:
+        bitboards: np.array. uint64 array of shape (T+1, 2, 6) (see
+        get_board_bitboards), the current position first.
+        num_steps: int. Positions of the window with bitboards.
+        ply: int. Length of the move stack of the game.
+        moves: tuple[chess.Move]. Last T moves of the game (fewer if it
+        hasn't made so many), the last one at the end.
+
+    Attributes:
+        T: int. Number of backward turns of the history.
+    """
+    def __init__(self, bitboards, num_steps, ply, moves=()):
+        self.bitboards = bitboards
+        self.num_steps = num_steps
+        self.ply = ply
+        self.moves = moves
+        self.T = len(bitboards) - 1
+
+    @classmethod
+    def from_board(cls, board, T=8):
+        """ Encodes the position of a board and its last T positions. """
+        # The moves of the board itself (the copy has copies of them)
+        moves = tuple(board.move_stack[-T:]) if T > 0 else ()
+        board = board.copy()
+        steps = min(T, len(board.move_stack)) + 1
+        ply = len(board.move_stack)
+        bitboards = np.zeros((T + 1, 2, 6), dtype=np.uint64)
+        bitboards[0] = get_board_bitboards(board)
+        for i in range(1, steps):
+            board.pop()
+            bitboards[i] = get_board_bitboards(board)
+        return cls(bitboards, steps, ply, moves)
+
+    def matches(self, board):
+        """ Returns whether it's the history of the board (the board may
+        have been changed without updating it): the board has made the
+        same number of moves, its last T moves are the ones of the history
+        and its pieces are the ones of the current position.
+        """
+        stack = board.move_stack
+        if self.ply != len(stack) or self._last_moves(stack) != self.moves:
+            return False
+        # Compared as python ints (faster than making the bitboards)
+        return _board_masks(board) == self.bitboards[0].tolist()
+
+    def _last_moves(self, stack):
+        """ Returns the last T moves of a move stack. """
+        return tuple(stack[-self.T:]) if self.T > 0 else ()
+
+    def push(self, board):
+        """ Returns the history after a move.
+
+        Parameters:
+            board: Python-Chess board. Board of this history after pushing a
+            move.
+        Returns:
+            history: EncodedHistory. New history (None if the board doesn't
+            follow this one).
+        """
+        stack = board.move_stack
+        if self.ply + 1 != len(stack) or \
+                self._last_moves(stack[-self.T - 1:-1]) != self.moves:
+            return None
+        bitboards = np.empty_like(self.bitboards)
+        bitboards[0] = get_board_bitboards(board)
+        bitboards[1:] = self.bitboards[:-1]
+        return EncodedHistory(bitboards, min(self.num_steps + 1, self.T + 1),
+                              self.ply + 1, self._last_moves(stack))
+
+    def get_game_state(self, turn, flipped=False):
+        """ Returns the input of the network (as get_game_state()). """
+        current = np.empty((1, 8, 8, 14 * (self.T + 1) + 1))
+        _fill_states([self], [turn], current, flipped)
+        return current[0]
+
+
+def track_history(game):
+    """ Makes a game (and the games copied from it) keep its EncodedHistory,
+    so get_game_state() only encodes the positions reached after this.
+
+    Parameters:
+        game: Game. Game to track.
+    Returns:
+        game: Game. The same game.
+    """
+    history = getattr(game, 'encoded_history', None)
+    if history is None or not history.matches(game.board):
+        game.encoded_history = EncodedHistory.from_board(game.board)
+    return game
+
+
+# Packed input of the network of a position (218 bytes instead of the 16 KB
+# of the float16 planes): for each position of the history (the current one
+# first), the bitboard of its occupied squares and the 4-bit code of the
+# piece of each one (1 + 6 * color + piece type - 1, in the order of the
+# squares, two per byte), plus the positions of the history and the turn.
+PACKED_STEPS = 9
+PACKED_DTYPE = np.dtype([('occupied', '<u8', (PACKED_STEPS,)),
+                         ('pieces', 'u1', (PACKED_STEPS, 16)),
+                         ('steps', 'u1'),
+                         ('turn', 'u1')])
+
+
+def pack_games(games, out=None):
+    """ Returns the packed inputs of several games (see PACKED_DTYPE). The
+    EncodedHistory of the games is used when they keep one. They're also
+    valid keys of the predictions (p.tobytes()): two games have the same
+    packed input if and only if the network sees the same input.
+
+    Parameters:
+        games: list[Game]. Games to pack.
+        out: np.array. Array of PACKED_DTYPE (with at least N records) where
+        they're written. If None, a new one is made.
+    Returns:
+        packed: np.array. PACKED_DTYPE array of N records.
+    """
+    n = len(games)
+    if out is None:
+        out = np.empty(n, dtype=PACKED_DTYPE)
+    out = out[:n]
+    if n == 0:
+        return out
+
+    histories = _game_histories(games, PACKED_STEPS - 1)
+    bitboards = np.stack([h.bitboards for h in histories])
+    bitboards = bitboards.reshape(n, PACKED_STEPS, 12)
+    data = np.ascontiguousarray(bitboards, dtype='<u8').view(np.uint8)
+    bits = np.unpackbits(data.reshape(n, PACKED_STEPS, 12, 8, 1), axis=-1,
+                         bitorder='little').reshape(n, PACKED_STEPS, 12, 64)
+    # Code of the piece of each square (0 if it's empty)
+    codes = (bits * np.arange(1, 13, dtype=np.uint8)[:, None]).max(axis=2)
+    occupied = codes > 0
+    if (occupied.sum(axis=-1) > 32).any():
+        raise ValueError("Positions with more than 32 pieces can't be packed")
+    # The codes of the occupied squares first (in order), then zeros
+    order = np.argsort(~occupied, axis=-1, kind='stable')[..., :32]
+    listed = np.take_along_axis(codes, order, axis=-1)
+
+    out['occupied'] = np.bitwise_or.reduce(bitboards, axis=-1)
+    out['pieces'] = listed[..., 0::2] | (listed[..., 1::2] << 4)
+    out['steps'] = [h.num_steps for h in histories]
+    out['turn'] = [g.turn for g in games]
+    return out
+
+
+def unpack_states(packed, out=None, dtype=np.float32, flipped=False):
+    """ Returns the inputs of the network (as get_game_states()) of packed
+    games (see pack_games).
+
+    Parameters:
+        packed: np.array. PACKED_DTYPE array of N records.
+        out: np.array. Array of shape (M, 8, 8, 127) (M >= N) where the
+        inputs are written. If None, a new one is made.
+        dtype: np.dtype. Type of the new array.
+        flipped: bool or list[bool]. Whether to rotate each board 180
+        degrees.
+    Returns:
+        states: np.array. Inputs of the games, (N, 8, 8, 127). A view of out
+        if it's given.
+    """
+    n = len(packed)
+    out = _states_array(n, PACKED_STEPS - 1, out, dtype)
+    if n == 0:
+        return out
+
+    data = np.ascontiguousarray(packed['occupied'], dtype='<u8')
+    occupied = np.unpackbits(data.view(np.uint8).reshape(
+        n, PACKED_STEPS, 8, 1), axis=-1, bitorder='little').reshape(
+        n, PACKED_STEPS, 64)
+    listed = np.empty((n, PACKED_STEPS, 32), dtype=np.uint8)
+    listed[..., 0::2] = packed['pieces'] & 15
+    listed[..., 1::2] = packed['pieces'] >> 4
+    # The k-th occupied square has the k-th code
+    index = np.maximum(np.cumsum(occupied, axis=-1) - 1, 0)
+    codes = np.take_along_axis(listed, index, axis=-1) * occupied
+
+    bits = codes[..., None] == np.arange(1, 13, dtype=np.uint8)
+    planes = _piece_planes(bits.reshape(n, PACKED_STEPS, 8, 8, 2, 6))
+    _write_states(planes, packed['steps'], packed['turn'], out, flipped)
+    return out
+
+
 def get_uci_labels():
     """ Returns a list of possible moves encoded as UCI (including
     promotions).
@@ -134,14 +494,144 @@ def get_uci_labels():
     return labels_array
 
 
+# Moves of the policy, built once: the UCI labels, the index of each one
+# and the moves themselves
+UCI_LABELS = get_uci_labels()
+UCI_IDS = {u: i for i, u in enumerate(UCI_LABELS)}
+POLICY_MOVES = [chess.Move.from_uci(u) for u in UCI_LABELS]
+
+# Index of the policy of each move by (from_square, to_square, promotion)
+# (promotion is 0 if there isn't one), -1 for the moves out of the policy
+MOVE_INDEX = np.full((64, 64, 7), -1, dtype=np.int32)
+for _i, _move in enumerate(POLICY_MOVES):
+    MOVE_INDEX[_move.from_square, _move.to_square, _move.promotion or 0] = _i
+_MOVE_INDEX_FLAT = MOVE_INDEX.ravel()
+
+
+def get_move_indices(moves):
+    """ Returns the indices of the policy of several moves.
+
+    Parameters:
+        moves: iterable[chess.Move]. Moves (e.g. board.legal_moves).
+    Returns:
+        indices: np.array. Index of each move (see MOVE_INDEX).
+    """
+    keys = [(m.from_square * 64 + m.to_square) * 7 + (m.promotion or 0)
+            for m in moves]
+    return _MOVE_INDEX_FLAT[keys]
+
+
+def get_legal_priors(policy, game):
+    """ Returns the probabilities of the legal moves of a game (in the
+    order of Game.get_legal_moves()) from a policy over all the moves.
+
+    Parameters:
+        policy: np.array. Policy over all the moves (see get_uci_labels).
+        game: Game. Game state.
+    Returns:
+        priors: np.array. Probability of each legal move.
+    """
+    return np.asarray(policy)[get_move_indices(game.board.legal_moves)]
+
+
+def get_policy_move(policy, game):
+    """ Returns the legal move of a game with the highest probability in a
+    policy over all the moves.
+
+    Parameters:
+        policy: np.array. Policy over all the moves (see get_uci_labels).
+        game: Game. Game state.
+    Returns:
+        move: chess.Move. Best legal move.
+    """
+    indices = get_move_indices(game.board.legal_moves)
+    return POLICY_MOVES[indices[np.argmax(np.asarray(policy)[indices])]]
+
+
+class PositionShard(object):
+    """ Positions of the games of a dataset, ready for the training: the
+    packed input of each position (see pack_games), the move played from it
+    and the result of its game. The positions of a game are contiguous.
+    They can be saved to (and loaded from) a .npz file.
+
+    Parameters:
+        positions: np.array. PACKED_DTYPE records.
+        moves: np.array. Index of the move played from each position (see
+        get_uci_labels).
+        results: np.array. Result of the game of each position (for the
+        whites).
+        offsets: np.array. First position of each game (and the number of
+        positions at the end).
+    """
+    def __init__(self, positions, moves, results, offsets):
+        self.positions = positions
+        self.moves = moves
+        self.results = results
+        self.offsets = offsets
+
+    @classmethod
+    def from_dataset(cls, dataset):
+        """ Packs the positions of the games of a DatasetGame.
+
+        Parameters:
+            dataset: DatasetGame. Games to pack.
+        Returns:
+            shard: PositionShard.
+        """
+        # The augmented games encode each position once
+        initial_history = EncodedHistory.from_board(chess.Board())
+        positions, moves, results = [], [], []
+        offsets = [0]
+        for game in dataset:
+            augmented = dataset.augment_game(game,
+                                             encoded_history=initial_history)
+            positions.append(pack_games([a['game'] for a in augmented]))
+            moves.extend([UCI_IDS[a['next_move']] for a in augmented])
+            results.extend([a['result'] for a in augmented])
+            offsets.append(offsets[-1] + len(augmented))
+        return cls(np.concatenate(positions) if len(positions) > 0 else
+                   np.empty(0, dtype=PACKED_DTYPE),
+                   np.asarray(moves, dtype=np.int16),
+                   np.asarray(results, dtype=np.float32),
+                   np.asarray(offsets, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """ Loads a shard saved with save(). """
+        with np.load(path) as data:
+            return cls(data['positions'], data['moves'], data['results'],
+                       data['offsets'])
+
+    def save(self, path):
+        """ Saves the shard to a .npz file. """
+        np.savez(path, positions=self.positions, moves=self.moves,
+                 results=self.results, offsets=self.offsets)
+
+    def __len__(self):
+        """ Number of games. """
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        """ Returns a shard with a slice (without step) of the games. """
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("Shards can only be sliced (without step)")
+        start, stop, _ = key.indices(len(self))
+        stop = max(start, stop)
+        begin, end = self.offsets[start], self.offsets[stop]
+        return PositionShard(self.positions[begin:end],
+                             self.moves[begin:end], self.results[begin:end],
+                             self.offsets[start:stop + 1] - begin)
+
+
 class DataGameSequence(Sequence):
     """ Transforms a Dataset to a Data generator to be fed to the training
-    loop of the neural network.
+    loop of the neural network. The positions of the games are packed once
+    (see PositionShard) and unpacked on each batch.
 
     Attributes:
-        dataset: DatasetGame. Dataset of fames
-        batch_size: int. Nb of board representations of each batch
-        uci_ids: dict. Encoding the move UCI labels to one-hot.
+        dataset: DatasetGame or PositionShard. Dataset of games
+        shard: PositionShard. Packed positions of the games.
+        batch_size: int. Nb of games of each batch
         random_flips: float. Proportion of board representation which will
                         be flipped 180 degrees.
     """
@@ -150,32 +640,24 @@ class DataGameSequence(Sequence):
                  random_flips=0):
         self.dataset = dataset
         self.batch_size = min(batch_size, len(dataset))
-        self.uci_ids = {u: i for i, u in enumerate(get_uci_labels())}
         self.random_flips = random_flips
+        if isinstance(dataset, PositionShard):
+            self.shard = dataset
+        else:
+            self.shard = PositionShard.from_dataset(dataset)
 
     def __len__(self):
         return int(len(self.dataset) / self.batch_size)
 
     def __getitem__(self, idx):
-        batch = self.dataset[idx * self.batch_size:
-                             (idx + 1) * self.batch_size]
-        batch_x = []  # Board reprs
-        batch_y_policies = []
-        batch_y_values = []
-
-        for i in batch:
-            i_augmented = self.dataset.augment_game(i)
-
-            flip = np.random.rand() < self.random_flips
-            batch_x.extend([get_game_state(i_g['game'], flipped=flip)
-                            for i_g in i_augmented])
-            batch_y_policies.extend([
-                to_categorical(self.uci_ids[targets['next_move']],
-                               num_classes=1968)
-                for targets in i_augmented]
-            )
-            batch_y_values.extend([targets['result']
-                                   for targets in i_augmented])
-
-        return np.asarray(batch_x), (np.asarray(batch_y_policies),
-                                     np.asarray(batch_y_values))
+        offsets = self.shard.offsets[idx * self.batch_size:
+                                     (idx + 1) * self.batch_size + 1]
+        start, end = offsets[0], offsets[-1]
+        # The same flip for all the positions of a game
+        flips = np.random.rand(len(offsets) - 1) < self.random_flips
+
+        batch_x = unpack_states(self.shard.positions[start:end],
+                                flipped=np.repeat(flips, np.diff(offsets)))
+        batch_y_policies = to_categorical(self.shard.moves[start:end],
+                                          num_classes=len(UCI_LABELS))
+        return batch_x, (batch_y_policies, self.shard.results[start:end])
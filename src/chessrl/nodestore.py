@@ -0,0 +1,177 @@
+"""
+Structure-of-arrays storage for the nodes of a Monte Carlo Tree. Instead of
+having one Python object per node (with its own lock, game copy and lists),
+all the statistics of the tree live in a few NumPy arrays indexed by the node
+id. The children of a node are always stored contiguously, so the stats of
+all of them can be read as a slice.
+"""
+
+import numpy as np
+import chess
+
+from threading import Condition
+
+
+NO_NODE = -1  # Node without children (yet)
+EXPANDING = -2  # Some thread is evaluating the node and creating its children
+
+NO_MOVE = -1  # Null move (i.e. the game ended before the opponent reply)
+UNRESOLVED = -2  # The opponent reply hasn't been computed yet
+RESOLVING = -3  # Some thread is computing the opponent reply
+
+NOT_OVER = 2  # Result of a game which has not finished
+
+NO_KEY = 0  # Node without position key
+
+
+def encode_move(move):
+    """ Packs a chess.Move into an int (from | to << 6 | promotion << 12)
+
+    Parameters:
+        move: chess.Move. Move to encode. None (or a null move) will be
+        encoded as NO_MOVE.
+    """
+    if not move:
+        return NO_MOVE
+    return move.from_square | (move.to_square << 6) |\
+        ((move.promotion or 0) << 12)
+
+
+def decode_move(code):
+    """ Unpacks an int made with encode_move. Returns None for the codes
+    which don't represent a move (NO_MOVE, UNRESOLVED...).
+    """
+    if code < 0:
+        return None
+    return chess.Move(code & 63, (code >> 6) & 63,
+                      promotion=(code >> 12) or None)
+
+
+class NodeStore(object):
+    """ Arrays holding the nodes of a tree. The arrays grow in chunks when
+    they are full. All writes must be done holding `lock`.
+
+    Attributes:
+        size: int. Number of allocated nodes.
+        visits: int32 array. Number of times each node has been visited.
+        value: float32 array. Sum of the values backpropagated to the node.
+        prior: float32 array. Prior probability given by the neural network.
+        vloss: int32 array. Virtual loss of each node.
+        child_visits: int32 array. Sum of the visits of the children.
+        parent: int32 array. Index of the parent node (NO_NODE for the root).
+        first_child: int32 array. Index of the first child, NO_NODE if the
+            node has not been expanded or EXPANDING if it's being expanded.
+        num_children: int16 array. Number of children.
+        move: int32 array. Encoded move which led to the node.
+        reply: int32 array. Encoded opponent reply made after `move`.
+        result: int8 array. Result of the game at the node (NOT_OVER if the
+            game is not finished).
+        key: uint64 array. Zobrist hash of the position (only for evaluated
+            nodes of trees using a transposition table).
+        lock: Condition. Lock of the store. Threads can also wait on it for
+            a node to be expanded/resolved by another thread.
+    """
+    CHUNK = 4096
+
+    FIELDS = (('visits', np.int32, 0),
+              ('value', np.float32, 0),
+              ('prior', np.float32, 1),
+              ('vloss', np.int32, 0),
+              ('child_visits', np.int32, 0),
+              ('parent', np.int32, NO_NODE),
+              ('first_child', np.int32, NO_NODE),
+              ('num_children', np.int16, 0),
+              ('move', np.int32, NO_MOVE),
+              ('reply', np.int32, UNRESOLVED),
+              ('result', np.int8, NOT_OVER),
+              ('key', np.uint64, NO_KEY))
+
+    def __init__(self, capacity=CHUNK):
+        self.size = 0
+        self.capacity = 0
+        self.lock = Condition()
+        for name, dtype, _ in self.FIELDS:
+            setattr(self, name, np.empty(0, dtype=dtype))
+        self._grow(capacity)
+
+    def _grow(self, min_capacity):
+        """ Enlarges the arrays (in chunks) to hold at least min_capacity
+        nodes. New positions are filled with the default values.
+        """
+        capacity = max(self.capacity, self.CHUNK)
+        while capacity < min_capacity:
+            capacity += self.CHUNK
+        if capacity == self.capacity:
+            return
+        for name, dtype, default in self.FIELDS:
+            arr = np.full(capacity, default, dtype=dtype)
+            arr[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, arr)
+        self.capacity = capacity
+
+    def allocate(self, n, parent=NO_NODE):
+        """ Reserves n contiguous nodes as children of parent.
+
+        Parameters:
+            n: int. Number of nodes.
+            parent: int. Index of the parent of the new nodes.
+        Returns:
+            first: int. Index of the first of the new nodes.
+        """
+        first = self.size
+        if first + n > self.capacity:
+            self._grow(first + n)
+        self.size += n
+        self.parent[first:self.size] = parent
+        if parent != NO_NODE:
+            self.first_child[parent] = first
+            self.num_children[parent] = n
+        return first
+
+    def children(self, index):
+        """ Returns the slice of the store with the children of a node """
+        first = self.first_child[index]
+        if first < 0:
+            return slice(0, 0)
+        return slice(first, first + self.num_children[index])
+
+    def subtree(self, index):
+        """ Copies the subtree of a node to a new store (where it will be the
+        root, index 0). The children blocks keep being contiguous.
+
+        Parameters:
+            index: int. Root of the subtree.
+        Returns:
+            store: NodeStore. New store with the subtree.
+        """
+        copied = [name for name, _, _ in self.FIELDS
+                  if name not in ('parent', 'first_child')]
+        new = NodeStore()
+        new.allocate(1)
+        for name in copied:
+            getattr(new, name)[0] = getattr(self, name)[index]
+
+        pending = [(index, 0)]
+        while len(pending) > 0:
+            old_node, new_node = pending.pop()
+            old_children = self.children(old_node)
+            n = old_children.stop - old_children.start
+            if n == 0:
+                continue
+            first = new.allocate(n, parent=new_node)
+            new_children = slice(first, first + n)
+            for name in copied:
+                getattr(new, name)[new_children] =\
+                    getattr(self, name)[old_children]
+            pending.extend(zip(range(old_children.start, old_children.stop),
+                               range(first, first + n)))
+        return new
+
+    @property
+    def nbytes(self):
+        """ Memory used by the allocated nodes (in bytes). """
+        return sum(getattr(self, name).itemsize for name, _, _ in self.FIELDS)\
+            * self.size
+
+    def __len__(self):
+        return self.size
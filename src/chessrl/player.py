@@ -12,3 +12,18 @@ class Player(object):
         pass the turn when it finishes (aka. notify the other players).
         """
         raise Exception('Abstract class.')
+
+    def evaluate(self, game:'Game'):  # noqa: E0602, F821
+        """ Evaluates a game with a single prediction.
+
+        Returns:
+            (priors, value). Prior probabilities of the legal moves (in the
+            order of Game.get_legal_moves()) and value of the position.
+        """
+        return self.evaluate_batch([game])[0]
+
+    def evaluate_batch(self, games):
+        """ Evaluates several games at once. Returns a list with the
+        (priors, value) of each game (see evaluate).
+        """
+        raise Exception('Abstract class.')
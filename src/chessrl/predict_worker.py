@@ -11,7 +11,10 @@ import socket
 
 class PredictWorker():
     """ This will run a separate process maintaining a model. Prediction
-    requests will be made to this class.
+    requests will be made to this class. A request is a PACKED_DTYPE array
+    with one or more packed games (see netencoder.pack_games), and it is
+    answered with a list of (policy, value) tuples, one per game (also when
+    the request has a single game).
     """
 
     def __init__(self,
@@ -24,6 +27,8 @@ class PredictWorker():
         self.connections = []
         self.to_ignore = set()
         self.conn_lock = Lock()
+        # Input of the model, reused by all the batches (grows as needed)
+        self.inputs = np.empty((0, 8, 8, 127), dtype=np.float16)
 
     def start(self):
         """ Opens a socket to listen to new connections and creates two
@@ -84,7 +89,7 @@ class PredictWorker():
 
             if not ready:
                 continue
-            data, result_conns = [], []
+            requests, result_conns = [], []
 
             for i, conn in enumerate(ready):
 
@@ -101,14 +106,24 @@ class PredictWorker():
                         self.to_ignore.add(conn)
                         break
 
-                    data.append(netencoder.get_game_state(g))
-                    result_conns.append(conn)
-
-            if len(data) > 0:
-                data = np.asarray(data, dtype=np.float16)
+                    # Packed games (see netencoder.pack_games)
+                    requests.append(g)
+                    result_conns.append((conn, len(g)))
+
+            if len(requests) > 0:
+                packed = np.concatenate(requests)
+                if len(packed) > len(self.inputs):
+                    self.inputs = np.empty((2 * len(packed),) +
+                                           self.inputs.shape[1:],
+                                           dtype=self.inputs.dtype)
+                # Unpacked right before the prediction
+                data = netencoder.unpack_states(packed, out=self.inputs)
                 policies, values = self.model.predict(data)
-                for conn, p, v in zip(result_conns, policies, values):
-                    conn.send((p, float(v)))
+                i = 0
+                for conn, n in result_conns:
+                    conn.send([(p, float(v[0])) for p, v in
+                               zip(policies[i:i + n], values[i:i + n])])
+                    i += n
 
     def __accept_connections(self):
         """ This method will accept all new connections and put them on
@@ -0,0 +1,244 @@
+"""
+Root parallel MCTS. The threads of a SelfPlayTree share the GIL, so the
+selection, expansion and move generation of the search don't scale with the
+number of cores. Here several processes run independent searches from the
+same root (each one with its own connection to the PredictWorker) and the
+visits of the root children are merged to choose the move.
+"""
+
+import multiprocessing
+import numpy as np
+import chess
+import netencoder
+
+from game import Game
+from searchstats import SearchStats
+from mctree import Node, SelfPlayTree, CompactSelfPlayTree, \
+    PlySelfPlayTree, SearchExecutor
+from transposition import TranspositionTable
+from timeit import default_timer as timer
+
+
+def _search_process(conn, endpoint, tree_args, reuse_tree, cache_size=0):
+    """ Loop of a search process. Receives (game, search arguments) tasks
+    and answers each one with the stats of the root children after the
+    search. A None task ends the loop.
+
+    Parameters:
+        conn: Connection. Pipe with the RootParallelTree.
+        endpoint: (str, int). Address of the PredictWorker.
+        tree_args: dict. Arguments of the tree (threads, batch_size...).
+            compact=True will use a CompactSelfPlayTree, ply=True a
+            PlySelfPlayTree and transposition_size > 0 a transposition table of that size.
+        reuse_tree: bool. Whether to keep the tree between searches.
+        cache_size: int. Max. predictions kept in the EvaluationCache of the
+        agent of the process (0 disables it).
+    """
+    # agentdistributed imports this module
+    from agentdistributed import AgentDistributed
+
+    agent = AgentDistributed(Game.WHITE, endpoint=endpoint,
+                             cache_size=cache_size)
+    agent.connect()
+
+    tree_args = dict(tree_args)
+    tree_class = SelfPlayTree
+    compact = tree_args.pop('compact', False)
+    ply = tree_args.pop('ply', False)
+    if compact:
+        tree_class = CompactSelfPlayTree
+    elif ply:
+        tree_class = PlySelfPlayTree
+    transposition_size = tree_args.pop('transposition_size', 0)
+    if transposition_size > 0:
+        tree_args['transpositions'] = TranspositionTable(transposition_size)
+    executor = SearchExecutor(tree_args.get('threads', 6))
+    tree_args['executor'] = executor
+
+    tree = None
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            game, search_args = task
+            if not reuse_tree or tree is None or not tree.reroot(game):
+                tree = tree_class(game, **tree_args)
+            tree.search_move(agent, noise=False, **search_args)
+
+            visits = tree.root_children_visits()
+            children = [(tree.get_child_moves(i), int(v))
+                        for i, v in enumerate(visits) if v > 0]
+            conn.send((children, tree.search_info))
+    finally:
+        executor.shutdown()
+        agent.disconnect()
+        conn.close()
+
+
+class RootParallelTree(SelfPlayTree):
+    """ Tree whose search is made by several processes, each one with its own
+    tree of the same root. Only the merged root children (with the sum of
+    their visits in all the processes) are kept here, so compute_policy and
+    get_child_moves work as in a SelfPlayTree. The processes are started with
+    the first search and live (keeping their trees) until close() is called.
+
+    Parameters:
+        root: Game. Root state of the tree.
+        endpoint: (str, int). Address of the PredictWorker.
+        processes: int. Number of search processes.
+        threads: int. Number of threads of each process.
+        compact: bool. Whether the processes use CompactSelfPlayTree.
+        ply: bool. Whether the processes use PlySelfPlayTree.
+        batch_size: int. See SelfPlayTree.
+        transposition_size: int. Max. positions of the transposition table
+        of each process (0 disables it).
+        root_noise: float. Weight of the Dirichlet noise mixed with the root
+        priors of each process. Without it the processes would make very
+        similar searches.
+        reuse_tree: bool. Whether the processes keep their trees between
+        moves.
+        cache_size: int. Max. predictions of the EvaluationCache of each
+        process (0 disables it).
+        max_nodes: int. Node cap of the tree of each process (None for no
+        limit). Ignored with compact trees.
+        widening: float. Progressive widening of the tree of each process
+        (None disables it). Ignored with compact trees.
+    """
+    def __init__(self, root, endpoint, processes=2, threads=1, compact=False,
+                 batch_size=1, transposition_size=0, root_noise=0.25,
+                 reuse_tree=True, cache_size=0, max_nodes=None, ply=False,
+                 widening=None):
+        super().__init__(root.get_copy(), threads=threads,
+                         batch_size=batch_size)
+        self.endpoint = endpoint
+        self.num_processes = processes
+        self.reuse_tree = reuse_tree
+        self.cache_size = cache_size
+        self.tree_args = {'threads': threads,
+                          'compact': compact,
+                          'ply': ply,
+                          'batch_size': batch_size,
+                          'transposition_size': transposition_size,
+                          'root_noise': root_noise}
+        if not compact:
+            self.tree_args['max_nodes'] = max_nodes
+            self.tree_args['widening'] = widening
+        self.workers = []
+
+    def start(self):
+        """ Starts the search processes. """
+        # The processes don't need anything from this one (and forking a
+        # process with TF loaded can hang).
+        context = multiprocessing.get_context('spawn')
+        for _ in range(self.num_processes):
+            conn, child_conn = context.Pipe()
+            proc = context.Process(target=_search_process,
+                                   args=(child_conn, self.endpoint,
+                                         self.tree_args, self.reuse_tree,
+                                         self.cache_size),
+                                   daemon=True)
+            proc.start()
+            child_conn.close()
+            self.workers.append((proc, conn))
+
+    def close(self):
+        """ Stops the search processes. """
+        for proc, conn in self.workers:
+            conn.send(None)
+            conn.close()
+        for proc, _ in self.workers:
+            proc.join()
+        self.workers = []
+
+    def reroot(self, game):
+        """ Moves the root to the game. Each process reroots its own tree (or
+        makes a new one) on the next search.
+        """
+        self.root = Node(netencoder.track_history(game.get_copy()))
+        self.root.visits = 1
+        return True
+
+    def search_move(self, agent, max_iters=200, verbose=False, noise=True,
+                    ai_move=False, max_time=None, early_stop=False,
+                    stats=False):
+        """ Searches the root on all the processes and selects the best move
+        from the merged visits. See SelfPlayTree.search_move.
+
+        Parameters:
+            agent: Player. Not used, each process has its own agent.
+            max_iters: int. Iterations of the whole search (split between
+            the processes).
+            stats: bool. Whether to collect the SearchStats of the search
+            (the ones of all the processes added up).
+        """
+        if max_iters is None and max_time is None:
+            raise ValueError("The search needs max_iters or max_time")
+        if len(self.workers) == 0:
+            self.start()
+
+        search_args = {'max_iters': max_iters,
+                       'max_time': max_time,
+                       'early_stop': early_stop,
+                       'verbose': verbose,
+                       'stats': stats}
+        if max_iters is not None:
+            search_args['max_iters'] = int(np.ceil(max_iters /
+                                                   self.num_processes))
+
+        start = timer()
+        game = self.root.state
+        for _, conn in self.workers:
+            conn.send((game, search_args))
+        results = [conn.recv() for _, conn in self.workers]
+        self._merge([children for children, _ in results])
+
+        reasons = [info['stop_reason'] for _, info in results]
+        self.search_info = {'iterations': sum(info['iterations']
+                                              for _, info in results),
+                            'time': timer() - start,
+                            'stop_reason': max(set(reasons),
+                                               key=reasons.count),
+                            'nodes': sum(info['nodes'] for _, info in results)}
+        if stats:
+            search_stats = SearchStats()
+            for _, info in results:
+                search_stats.merge(info['stats'])
+            # The processes search at the same time
+            search_stats.elapsed = self.search_info['time']
+            self.search_info['stats'] = search_stats
+
+        max_val = np.argmax(self.compute_policy(self.root, noise=noise))
+        moves = self.get_child_moves(max_val)
+
+        if not ai_move:
+            moves = moves[0]
+        return moves
+
+    def _merge(self, results):
+        """ Makes the root children with the visits of all the processes.
+
+        Parameters:
+            results: list. For each process, list of ((move, reply), visits)
+            of its root children.
+        """
+        visits = {}
+        replies = {}
+        for children in results:
+            for (move, reply), v in children:
+                visits[move] = visits.get(move, 0) + v
+                # Keep the reply of the process which visited it most
+                if v > replies.get(move, (None, 0))[1]:
+                    replies[move] = (reply, v)
+
+        root = Node(self.root.state)
+        root.visits = 1 + sum(visits.values())
+        for move, v in visits.items():
+            reply = replies[move][0]
+            child = Node(parent=root, move=chess.Move.from_uci(move),
+                         reply=None if reply == Game.NULL_MOVE else
+                         chess.Move.from_uci(reply))
+            root.add_child(child)
+            child.visits = v
+            child.sync()
+        self.root = root
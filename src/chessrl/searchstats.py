@@ -0,0 +1,214 @@
+"""
+Instrumentation of the tree searches. Each search thread fills its own
+SearchStats (so collecting them needs no locks) and the ones of all the
+threads are merged at the end of the search.
+"""
+
+import numpy as np
+
+from timeit import default_timer as timer
+
+
+PHASES = ('select', 'expand', 'opponent_move', 'eval_wait', 'backprop')
+
+# Bucket b of the histograms counts the durations in [2^(b-1), 2^b) usecs
+# (bucket 0 is < 1 usec and the last one everything above ~16 secs).
+HISTOGRAM_BUCKETS = 26
+
+
+def bucket_bounds(bucket):
+    """ Returns the (lower, upper) bounds (in secs) of a histogram bucket. """
+    lower = 0 if bucket == 0 else 2 ** (bucket - 1) / 1e6
+    upper = np.inf if bucket == HISTOGRAM_BUCKETS - 1 else 2 ** bucket / 1e6
+    return lower, upper
+
+
+class _Phase(object):
+    """ Context manager which measures a phase of a SearchStats """
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats.start(self.name)
+
+    def __exit__(self, *exc):
+        self.stats.stop()
+
+
+class _Locked(object):
+    """ Context manager which acquires a lock counting the contention """
+    __slots__ = ('stats', 'lock')
+
+    def __init__(self, stats, lock):
+        self.stats = stats
+        self.lock = lock
+
+    def __enter__(self):
+        self.stats.acquire(self.lock)
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+class SearchStats(object):
+    """ Counters and timings of a search. The phases are nested (e.g. the
+    opponent move happens during an expansion, which happens during a
+    selection) and each one only accounts its own time (not the one of the
+    phases inside it).
+
+    Attributes:
+        counts: dict. Number of times each phase has been run.
+        times: dict. Seconds spent in each phase (added up over the threads).
+        histograms: dict. Histogram of the durations of each phase (see
+        HISTOGRAM_BUCKETS).
+        leaves: int. Number of selected leaves.
+        depth_sum: int. Sum of the depths of the leaves.
+        max_depth: int. Depth of the deepest leaf.
+        expansions: int. Number of nodes whose children have been created.
+        children: int. Sum of the children of the expanded nodes.
+        lock_acquisitions: int. Number of times the tree locks were taken.
+        lock_contentions: int. Acquisitions which had to wait for another
+        thread.
+        lock_wait: float. Seconds waiting for the locks.
+        node_waits: int. Times a thread waited for a node being expanded
+        by another one.
+        node_wait: float. Seconds spent in those waits.
+        iterations: int. Evaluated leaves (set when the search ends).
+        elapsed: float. Wall time of the search (set when the search ends).
+    """
+    def __init__(self):
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.times = dict.fromkeys(PHASES, 0.)
+        self.histograms = {p: np.zeros(HISTOGRAM_BUCKETS, dtype=np.int64)
+                           for p in PHASES}
+        self.leaves = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self.expansions = 0
+        self.children = 0
+        self.lock_acquisitions = 0
+        self.lock_contentions = 0
+        self.lock_wait = 0.
+        self.node_waits = 0
+        self.node_wait = 0.
+        self.iterations = 0
+        self.elapsed = 0.
+        # Phases in progress: [name, accounted secs, start of the last run]
+        self._running = []
+
+    def phase(self, name):
+        """ Returns a context manager which measures a phase. """
+        return _Phase(self, name)
+
+    def locked(self, lock):
+        """ Returns a context manager which holds a lock (see acquire). """
+        return _Locked(self, lock)
+
+    def start(self, name):
+        now = timer()
+        if len(self._running) > 0:
+            # Pause the enclosing phase
+            outer = self._running[-1]
+            outer[1] += now - outer[2]
+        self._running.append([name, 0., now])
+
+    def stop(self):
+        now = timer()
+        name, elapsed, since = self._running.pop()
+        self.add(name, elapsed + now - since)
+        if len(self._running) > 0:
+            self._running[-1][2] = now
+
+    def add(self, name, elapsed):
+        """ Accounts a run of a phase which took elapsed secs. """
+        self.counts[name] += 1
+        self.times[name] += elapsed
+        bucket = min(int(elapsed * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histograms[name][bucket] += 1
+
+    def acquire(self, lock):
+        """ Acquires a lock, measuring the time waited if it was taken. """
+        self.lock_acquisitions += 1
+        if not lock.acquire(blocking=False):
+            start = timer()
+            lock.acquire()
+            self.lock_contentions += 1
+            self.lock_wait += timer() - start
+
+    def add_node_wait(self, elapsed):
+        self.node_waits += 1
+        self.node_wait += elapsed
+
+    def add_leaf(self, depth):
+        self.leaves += 1
+        self.depth_sum += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def add_expansion(self, children):
+        self.expansions += 1
+        self.children += children
+
+    def merge(self, other):
+        """ Adds the stats of other (another thread or search) to these. """
+        for p in PHASES:
+            self.counts[p] += other.counts[p]
+            self.times[p] += other.times[p]
+            self.histograms[p] += other.histograms[p]
+        for name in ('leaves', 'depth_sum', 'expansions', 'children',
+                     'lock_acquisitions', 'lock_contentions', 'lock_wait',
+                     'node_waits', 'node_wait', 'iterations', 'elapsed'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_depth = max(self.max_depth, other.max_depth)
+        return self
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_running'] = []
+        return state
+
+    def summary(self):
+        """ Returns a dict with the main figures of the stats: the count,
+        total and mean time of each phase, nodes/sec, depth, branching factor
+        and lock contention.
+        """
+        phases = {p: {'count': self.counts[p],
+                      'time': self.times[p],
+                      'mean': self.times[p] / max(self.counts[p], 1)}
+                  for p in PHASES}
+        return {'phases': phases,
+                'iterations': self.iterations,
+                'nodes_per_sec': self.iterations / self.elapsed
+                if self.elapsed > 0 else 0,
+                'max_depth': self.max_depth,
+                'avg_depth': self.depth_sum / max(self.leaves, 1),
+                'branching_factor': self.children / max(self.expansions, 1),
+                'lock_contention': self.lock_contentions /
+                max(self.lock_acquisitions, 1),
+                'lock_wait': self.lock_wait,
+                'node_waits': self.node_waits,
+                'node_wait': self.node_wait}
+
+    def __str__(self):
+        s = self.summary()
+        lines = [f"{s['iterations']} iterations, "
+                 f"{s['nodes_per_sec']:.1f} nodes/sec, "
+                 f"depth {s['avg_depth']:.2f} (max {s['max_depth']}), "
+                 f"branching {s['branching_factor']:.1f}, "
+                 f"lock contention {100 * s['lock_contention']:.1f}% "
+                 f"({s['lock_wait'] * 1e3:.1f} ms), "
+                 f"node waits {s['node_waits']} "
+                 f"({s['node_wait'] * 1e3:.1f} ms)"]
+        for p, info in s['phases'].items():
+            if info['count'] == 0:
+                continue
+            busy = np.flatnonzero(self.histograms[p])
+            low, _ = bucket_bounds(busy[0])
+            _, high = bucket_bounds(busy[-1])
+            lines.append(f"  {p:<14}{info['count']:>8} x "
+                         f"{info['mean'] * 1e3:9.3f} ms = "
+                         f"{info['time']:8.3f} s "
+                         f"[{low * 1e3:.3f}, {high * 1e3:.3f}) ms")
+        return "\n".join(lines)
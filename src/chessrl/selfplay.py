@@ -2,6 +2,8 @@ from agentdistributed import AgentDistributed
 from agent import Agent
 from game import Game
 from predict_worker import PredictWorker
+from searchstats import SearchStats
+from treesnapshot import write_snapshot
 from lib.logger import Logger
 
 from dataset import DatasetGame
@@ -56,7 +58,26 @@ def get_model_path(directory):
     return path
 
 
-def play_game(agent):
+def play_game(agent, max_iters=900, max_time=None, early_stop=False,
+              stats=False, snapshot_dir=None):
+    """ Plays a game of the agent against itself.
+
+    Parameters:
+        agent: AgentDistributed. Agent which plays the game.
+        max_iters: int. Max. iterations of the search of each move (None for
+        no limit).
+        max_time: float. Max. seconds of the search of each move (None for no
+        limit).
+        early_stop: bool. Whether to stop each search once its best move
+        can't change.
+        stats: bool. Whether to collect the SearchStats of the searches (a
+        summary of all of them is logged at the end of the game).
+        snapshot_dir: str. Directory where the tree of each search is
+        written (see treesnapshot) as move-<ply>.tree. None to not write
+        them.
+    Returns:
+        game: Game. Played game.
+    """
     logger = Logger.get_instance()
 
     player_color = True if random.random() >= 0.5 else False
@@ -69,26 +90,59 @@ def play_game(agent):
         # Make the oponent move
         gam.move(agent.best_move(gam, real_game=True))
 
+    game_stats = SearchStats() if stats else None
+
     # Play until finish
     while gam.get_result() is None:
         start = timer()
         bm, am = agent.best_move(gam, real_game=False, ai_move=True,
-                                 max_iters=900)
+                                 max_iters=max_iters, max_time=max_time,
+                                 early_stop=early_stop, stats=stats)
+        if snapshot_dir is not None and agent.tree is not None:
+            write_snapshot(agent.tree, os.path.join(
+                snapshot_dir, f"move-{len(gam.board.move_stack)}.tree"))
         gam.move(bm)  # Make our move
         gam.move(am)  # Make oponent move
         end = timer()
         elapsed = round(end - start, 2)
-        logger.debug(f"\tMade move: {bm}, took: {elapsed} secs")
+        iters = agent.search_info['iterations']
+        nodes = agent.search_info['nodes']
+        logger.debug(f"\tMade move: {bm}, took: {elapsed} secs, "
+                     f"{iters} iterations, {nodes} nodes")
+        if stats:
+            game_stats.merge(agent.search_info['stats'])
     logger.debug(gam.get_history())
+    if stats:
+        logger.info(f"Search stats of the game: {game_stats}")
 
     return gam
 
 
-def play_game_job(endpoint, result_placeholder, threads):
+def play_game_job(endpoint, result_placeholder, threads, compact=False,
+                  batch_size=1, transposition_size=0, max_iters=900,
+                  max_time=None, early_stop=False, processes=0,
+                  stats=False, cache_size=0, max_nodes=None, ply=False,
+                  widening=None, snapshot_dir=None):
     agent = AgentDistributed(Game.WHITE, endpoint=endpoint,
-                             num_threads=threads)
+                             num_threads=threads, compact_tree=compact,
+                             batch_size=batch_size,
+                             transposition_size=transposition_size,
+                             processes=processes, cache_size=cache_size,
+                             max_nodes=max_nodes, ply_tree=ply,
+                             widening=widening)
     agent.connect()
-    gam = play_game(agent)
+    if snapshot_dir is not None:
+        os.makedirs(snapshot_dir, exist_ok=True)
+    gam = play_game(agent, max_iters=max_iters, max_time=max_time,
+                    early_stop=early_stop, stats=stats,
+                    snapshot_dir=snapshot_dir)
+    agent.disconnect()
+
+    if agent.cache is not None:
+        cache = agent.cache
+        Logger.get_instance().info(
+            f"Evaluation cache: {round(100 * cache.hit_rate, 1)}% hits, "
+            f"{len(cache)} positions, {cache.nbytes // 2**20} MB")
 
     d = DatasetGame()
     d.append(gam)
@@ -118,6 +172,63 @@ def main():
                         default=1)
     parser.add_argument('--threads', metavar='threads', type=int,
                         default=6)
+    parser.add_argument('--processes', metavar='processes', type=int,
+                        default=0,
+                        help="Processes of the root parallel search, each "
+                        "one with --threads threads (0 searches with the "
+                        "threads of a single process)")
+    parser.add_argument('--batch', metavar='batch', type=int,
+                        default=1,
+                        help="Leaves evaluated at once by each search thread")
+    parser.add_argument('--tt-size', metavar='tt_size', type=int,
+                        default=0,
+                        help="Max. positions of the transposition table "
+                        "(0 disables it)")
+    parser.add_argument('--cache-size', metavar='cache_size', type=int,
+                        default=10000,
+                        help="Max. predictions kept by the evaluation cache "
+                        "of the agent (0 disables it)")
+    parser.add_argument('--max-nodes', metavar='max_nodes', type=int,
+                        default=None,
+                        help="Max. nodes of the search tree. The least "
+                        "visited subtrees are pruned when it's reached")
+    parser.add_argument('--widening', metavar='widening', type=float,
+                        default=None,
+                        help="Progressive widening: a node with N visits "
+                        "only has its ceil(widening * sqrt(N)) moves with the"
+                        " highest priors (disabled by default)")
+    parser.add_argument('--compact',
+                        action='store_true',
+                        default=False,
+                        help="Store the search tree nodes in arrays instead"
+                        " of objects (less memory). Default false.")
+    parser.add_argument('--ply',
+                        action='store_true',
+                        default=False,
+                        help="Search tree with a node per ply, which also "
+                        "searches the opponent moves (no extra prediction "
+                        "for them). Can't be used with --compact. Default "
+                        "false.")
+    parser.add_argument('--iters', metavar='iters', type=int,
+                        default=900,
+                        help="Max. iterations of the search of each move")
+    parser.add_argument('--max-time', metavar='max_time', type=float,
+                        default=None,
+                        help="Max. seconds of the search of each move")
+    parser.add_argument('--early-stop',
+                        action='store_true',
+                        default=False,
+                        help="Stop each search once its best move can't "
+                        "change in the remaining budget. Default false.")
+    parser.add_argument('--stats',
+                        action='store_true',
+                        default=False,
+                        help="Collect and log the stats (time of each "
+                        "phase, depth, lock contention...) of the searches."
+                        " Default false.")
+    parser.add_argument('--snapshots', metavar='snapshots', default=None,
+                        help="Directory where the search trees are written "
+                        "(a subdirectory per game, see treesnapshot.py)")
     parser.add_argument('--debug',
                         action='store_true',
                         default=False,
@@ -140,12 +251,28 @@ def main():
     return_dict = manager.dict()
 
     for i in range(args.games):
+        snapshot_dir = None
+        if args.snapshots is not None:
+            snapshot_dir = os.path.join(args.snapshots, f"game-{i + 1}")
         worker.start()
         logger.info(f"Game {i+1} of {args.games}")
         proci = multiprocessing.Process(target=play_game_job,
                                         args=(endpoint,
                                               return_dict,
-                                              args.threads)
+                                              args.threads,
+                                              args.compact,
+                                              args.batch,
+                                              args.tt_size,
+                                              args.iters,
+                                              args.max_time,
+                                              args.early_stop,
+                                              args.processes,
+                                              args.stats,
+                                              args.cache_size,
+                                              args.max_nodes,
+                                              args.ply,
+                                              args.widening,
+                                              snapshot_dir)
                                         )
         proci.start()
         proci.join()
@@ -3,6 +3,7 @@ from dataset import DatasetGame
 from lib.logger import Logger
 
 import argparse
+import netencoder
 import os
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1'
@@ -34,20 +35,31 @@ def get_model_path(directory):
     return path
 
 
-def train(model_dir, dataset_path, epochs=1, batch_size=8):
+def train(model_dir, dataset_path, epochs=1, batch_size=8, shard_path=None):
     """ Loads (or creates, if not found) a model from model_dir, trains it
     and saves the results.
 
     Parameters:
         model_dir: str. Directory which contains the model
-        dataset_string: str. DatasetGame serialized as a string.
+        dataset_path: str. Path of the dataset: a DatasetGame (.json) or a
+        netencoder.PositionShard (.npz), whose positions are already packed.
+        shard_path: str. Where to save the packed positions of a .json
+        dataset (as a PositionShard), so they can be used again.
     """
     logger = Logger.get_instance()
 
     logger.info("Loading dataset")
 
-    data_train = DatasetGame()
-    data_train.load(dataset_path)
+    if dataset_path.endswith('.npz'):
+        data_train = netencoder.PositionShard.load(dataset_path)
+    else:
+        data_train = DatasetGame()
+        data_train.load(dataset_path)
+        if shard_path is not None:
+            data_train = netencoder.PositionShard.from_dataset(data_train)
+            data_train.save(shard_path)
+            logger.info(f"Saved {len(data_train.positions)} positions "
+                        f"to {shard_path}")
 
     model_path = get_model_path(model_dir)
 
@@ -70,7 +82,11 @@ def main():
                         help="where to store (and load from)"
                         "the trained model and the logs")
     parser.add_argument('data_path', metavar='datadir',
-                        help="Path of .JSON dataset.")
+                        help="Path of .JSON dataset (or a .npz shard "
+                        "saved with --save-shard).")
+    parser.add_argument('--save-shard', metavar='save_shard', default=None,
+                        help="Save the packed positions of the dataset to "
+                        "this .npz file.")
     parser.add_argument('--epochs', metavar='epochs', type=int,
                         default=1)
     parser.add_argument('--bs', metavar='bs', help="Batch size. Default 8", type=int,
@@ -88,7 +104,8 @@ def main():
     if args.debug:
         logger.set_level(0)
 
-    train(args.model_dir, args.data_path, args.epochs, args.bs)
+    train(args.model_dir, args.data_path, args.epochs, args.bs,
+          shard_path=args.save_shard)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+"""
+Transposition table for the Monte Carlo trees. Different move orders often
+reach the same position, so the nodes of the same position (identified by its
+Zobrist hash) can share the evaluation of the neural net and the statistics of
+their visits instead of asking the network again.
+"""
+
+import chess.polyglot
+
+from collections import OrderedDict
+from threading import Lock
+
+
+def position_key(board):
+    """ Returns the Zobrist hash of a python-chess board. Note that the
+    history of the game is not part of the key.
+    """
+    return chess.polyglot.zobrist_hash(board)
+
+
+class Entry(object):
+    """ Evaluation and statistics of a position.
+
+    Attributes:
+        priors: list. Prior probabilities of the legal moves (in the order
+        given by Game.get_legal_moves()).
+        nn_value: float. Value given by the neural net.
+        visits: int. Visits of all the nodes with this position.
+        value: float. Sum of the values backpropagated through them.
+    """
+    __slots__ = ('priors', 'nn_value', 'visits', 'value')
+
+    def __init__(self, priors, nn_value):
+        self.priors = priors
+        self.nn_value = nn_value
+        self.visits = 0
+        self.value = 0
+
+    def get_value(self):
+        """ Expected value of the position. The mean of the backpropagated
+        values if there are any, the one of the neural net if not.
+        """
+        if self.visits == 0:
+            return self.nn_value
+        return self.value / self.visits
+
+
+class TranspositionTable(object):
+    """ Bounded table of position entries. When it's full, the least
+    recently used entry is evicted.
+
+    Attributes:
+        max_size: int. Max. number of entries.
+        hits: int. Number of lookups which found the position.
+        misses: int. Number of lookups which didn't find the position.
+        evictions: int. Number of evicted entries.
+    """
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        """ Returns the entry of a position (None if it's not in the table).
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, priors, nn_value):
+        """ Adds the evaluation of a position to the table. """
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = Entry(priors, nn_value)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, value):
+        """ Adds a visit with the given value to the stats of a position. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.visits += 1
+                entry.value += value
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,226 @@
+"""
+Binary snapshots of the search trees. Building nested dicts of a whole tree
+(as lib/treeviewer does) doesn't work with large searches, so the trees are
+written to disk as fixed-size records (one per node) in chunks, and read
+back as a NumPy array. The exporter only takes the most visited children of
+each node down to a given depth, which is what can actually be looked at.
+
+File format (little endian):
+    header: MAGIC, version (uint16), flags (uint16), length of the FEN of
+    the root (uint16) and the FEN (utf-8).
+    records: NODE_DTYPE until the end of the file. The root is the first
+    one and every node comes after its parent.
+"""
+
+import argparse
+import json
+import struct
+
+import numpy as np
+
+import nodestore
+
+from mctree import CompactSelfPlayTree, PlySelfPlayTree
+
+
+MAGIC = b'CRLT'
+VERSION = 1
+HEADER = struct.Struct('<4sHHH')
+
+# The values of the nodes are from the point of view of the player who made
+# their move (PlySelfPlayTree). Otherwise, they're for the whites.
+FLAG_PLY = 1
+
+NODE_DTYPE = np.dtype([('parent', '<i4'),   # -1 for the root
+                       ('move', '<i4'),     # nodestore.encode_move
+                       ('reply', '<i4'),    # NO_MOVE/UNRESOLVED if none
+                       ('visits', '<i4'),
+                       ('value', '<f4'),    # Sum of the values
+                       ('prior', '<f4')])
+
+# Nodes written at once
+CHUNK = 4096
+
+
+def write_snapshot(tree, path, chunk_size=CHUNK):
+    """ Writes a tree to a file. The nodes are streamed in chunks of
+    chunk_size records, so the memory used doesn't depend on the size of the
+    tree. It must not be called while the tree is being searched.
+
+    Parameters:
+        tree: Tree. Any of the trees of mctree (or a RootParallelTree).
+        path: str. Path of the file.
+        chunk_size: int. Nodes written at once.
+    Returns:
+        nodes: int. Number of nodes written.
+    """
+    flags = FLAG_PLY if isinstance(tree, PlySelfPlayTree) else 0
+    if isinstance(tree, CompactSelfPlayTree):
+        fen = tree.game.board.fen()
+    else:
+        fen = tree.root.state.board.fen()
+    fen = fen.encode('utf-8')
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, flags, len(fen)))
+        f.write(fen)
+        if isinstance(tree, CompactSelfPlayTree):
+            return _write_store(tree.store, f, chunk_size)
+        return _write_nodes(tree.root, f, chunk_size)
+
+
+def _write_nodes(root, f, chunk_size):
+    """ Writes the records of a tree of Nodes (in depth-first order) """
+    buffer = np.zeros(chunk_size, dtype=NODE_DTYPE)
+    written = size = 0
+    pending = [(root, -1)]
+    while len(pending) > 0:
+        node, parent = pending.pop()
+        buffer[size] = (parent, nodestore.encode_move(node.move),
+                        nodestore.encode_move(node.reply), node.visits,
+                        node.value, node.prior)
+        index = written + size
+        size += 1
+        if size == chunk_size:
+            f.write(buffer.tobytes())
+            written += size
+            size = 0
+        pending.extend((c, index) for c in reversed(node.children))
+    f.write(buffer[:size].tobytes())
+    return written + size
+
+
+def _write_store(store, f, chunk_size):
+    """ Writes the records of a NodeStore (in the order of the store, where
+    the parents always come before their children).
+    """
+    buffer = np.zeros(chunk_size, dtype=NODE_DTYPE)
+    size = len(store)
+    for start in range(0, size, chunk_size):
+        end = min(start + chunk_size, size)
+        chunk = buffer[:end - start]
+        for name in NODE_DTYPE.names:
+            chunk[name] = getattr(store, name)[start:end]
+        f.write(chunk.tobytes())
+    return size
+
+
+class TreeSnapshot(object):
+    """ Tree read from a snapshot file. The records are memory mapped, so
+    opening a large snapshot is fast and only the visited parts are read.
+
+    Parameters:
+        path: str. Path of the snapshot.
+
+    Attributes:
+        fen: str. FEN of the root position.
+        ply: bool. Whether the values are from the point of view of the
+        player who made each move (instead of the whites).
+        nodes: np.array. Records of the nodes (see NODE_DTYPE).
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            magic, version, flags, fen_size = HEADER.unpack(
+                f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a tree snapshot")
+            self.fen = f.read(fen_size).decode('utf-8')
+        self.ply = bool(flags & FLAG_PLY)
+        self.nodes = np.memmap(path, dtype=NODE_DTYPE, mode='r',
+                               offset=HEADER.size + fen_size)
+        self._order = None
+        self._offsets = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def children(self, index):
+        """ Returns the indices of the children of a node. """
+        if self._order is None:
+            # Children grouped by parent (built on the first call)
+            parents = np.asarray(self.nodes['parent'][1:])
+            self._order = np.argsort(parents, kind='stable') + 1
+            counts = np.bincount(parents, minlength=len(self.nodes))
+            self._offsets = np.concatenate(([0], np.cumsum(counts)))
+        return self._order[self._offsets[index]:self._offsets[index + 1]]
+
+    def get_moves(self, index):
+        """ Returns the move (UCI) of a node and the reply of the opponent
+        (None if there's no reply).
+        """
+        node = self.nodes[index]
+        moves = [nodestore.decode_move(node['move']),
+                 nodestore.decode_move(node['reply'])]
+        return tuple(m.uci() if m else None for m in moves)
+
+    def top_k(self, k=3, depth=3, index=0):
+        """ Returns a dict with a node and its k most visited children (and
+        theirs, recursively) down to the given depth.
+
+        Parameters:
+            k: int. Children of each node.
+            depth: int. Levels below the node.
+            index: int. Node where the export starts (the root by default).
+        Returns:
+            node: dict. 'move', 'reply', 'visits', 'q' (mean value), 'prior'
+            and 'children' (list of the same dicts).
+        """
+        node = self.nodes[index]
+        move, reply = self.get_moves(index)
+        visits = int(node['visits'])
+        exported = {'move': move, 'reply': reply, 'visits': visits,
+                    'q': float(node['value']) / max(visits, 1),
+                    'prior': float(node['prior']),
+                    'children': []}
+        if depth > 0:
+            children = self.children(index)
+            best = children[np.argsort(-self.nodes['visits'][children],
+                                       kind='stable')[:k]]
+            exported['children'] = [self.top_k(k, depth - 1, c)
+                                    for c in best]
+        return exported
+
+    def summary(self):
+        """ Returns a dict with the number of nodes, the visits of the root
+        and the depth of the tree.
+        """
+        parents = np.asarray(self.nodes['parent'])
+        depths = np.zeros(len(parents), dtype=np.int32)
+        # Climb from all the nodes at once until they reach the root
+        ancestors = parents.copy()
+        while True:
+            climbing = ancestors >= 0
+            if not climbing.any():
+                break
+            depths += climbing
+            ancestors[climbing] = parents[ancestors[climbing]]
+        return {'nodes': len(self), 'root_visits': int(self.nodes[0]['visits']),
+                'depth': int(depths.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports the most visited "
+                                     "part of a tree snapshot to JSON.")
+    parser.add_argument('snapshot', metavar='snapshot',
+                        help="Snapshot file (see write_snapshot)")
+    parser.add_argument('--top-k', metavar='top_k', type=int, default=3,
+                        help="Children of each node")
+    parser.add_argument('--depth', metavar='depth', type=int, default=3,
+                        help="Levels of the tree")
+    parser.add_argument('--out', metavar='out', default=None,
+                        help="JSON file (printed if not given)")
+    args = parser.parse_args()
+
+    snapshot = TreeSnapshot(args.snapshot)
+    exported = {'fen': snapshot.fen, 'ply': snapshot.ply,
+                'summary': snapshot.summary(),
+                'tree': snapshot.top_k(args.top_k, args.depth)}
+    if args.out is None:
+        print(json.dumps(exported, indent=2))
+    else:
+        with open(args.out, 'w') as f:
+            json.dump(exported, f)
+
+
+if __name__ == "__main__":
+    main()